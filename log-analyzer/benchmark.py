@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import log_analyzer
+from log_analyzer import (
+    EXTERNAL_GZIP_DECOMPRESSORS,
+    get_config,
+    get_report_file_path,
+    LINE_PARSERS,
+    LogFile,
+    open_log_file,
+    parse_line,
+    parse_log,
+    parse_record,
+    RunStats,
+    write_report,
+)
+
+LOG_DATE = datetime(2017, 6, 30)
+STATUS_WEIGHTS = {200: 0.95, 404: 0.03, 499: 0.01, 500: 0.005, 504: 0.005}
+LINE_TEMPLATE = (
+    '{ip} -  - [{date} +0300] "GET {url} HTTP/1.1" {status} {length} "-" "Mozilla/5.0" "-" '
+    '"{request_id}" "-" {request_time:.3f}\n'
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--log', default='./log/nginx-access-ui.log-20170630')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--target', choices=['parsers', 'gzip', 'pipeline'], default='parsers')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=10000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--error-fraction', type=float, default=0.01)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output')
+    return parser.parse_args()
+
+
+def generate_log(file_path, lines, urls, zipf, error_fraction, seed=1, batch_size=10000):
+    rnd = random.Random(seed)
+    url_weights = list(accumulate(1 / rank ** zipf for rank in range(1, urls + 1)))
+    url_scales = [rnd.lognormvariate(-2, 1) for _ in range(urls)]
+    statuses, status_weights = list(STATUS_WEIGHTS), list(accumulate(STATUS_WEIGHTS.values()))
+    last_seconds = date = None
+    with (gzip.open if file_path.endswith('.gz') else open)(file_path, 'wt') as file:
+        for batch_start in range(0, lines, batch_size):
+            size = min(batch_size, lines - batch_start)
+            url_ids = rnd.choices(range(urls), cum_weights=url_weights, k=size)
+            line_statuses = rnd.choices(statuses, cum_weights=status_weights, k=size)
+            for index, (url_id, status) in enumerate(zip(url_ids, line_statuses), batch_start):
+                seconds = index * 86400 // lines
+                if seconds != last_seconds:
+                    last_seconds = seconds
+                    date = (LOG_DATE + timedelta(seconds=seconds)).strftime('%d/%b/%Y:%H:%M:%S')
+                line = LINE_TEMPLATE.format(
+                    ip=f'1.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}',
+                    date=date,
+                    url=f'/api/v2/banner/{url_id}' if url_id % 2 else f'/api/1/campaigns/?id={url_id}',
+                    status=status,
+                    length=rnd.randrange(10, 20000),
+                    request_id=f'{index}-{rnd.getrandbits(32)}',
+                    request_time=rnd.expovariate(1 / url_scales[url_id]),
+                )
+                if rnd.random() < error_fraction:
+                    line = line[:len(line) // 3] + '\n'
+                file.write(line)
+
+
+def read_lines(file_path, repeat):
+    with open_log_file(file_path) as file:
+        return list(file) * repeat
+
+
+def benchmark(parse, lines):
+    started_at = time.perf_counter()
+    for line in lines:
+        parse(line)
+    return len(lines) / (time.perf_counter() - started_at)
+
+
+def benchmark_parsers(lines):
+    results = {'groupdict': benchmark(lambda line: parse_line(line.decode('utf-8')), lines)}
+    for name, parse in LINE_PARSERS.items():
+        results[name] = benchmark(parse, lines)
+    return results
+
+
+def benchmark_gzip_backend(file_path, gzip_backend, parse=None):
+    started_at = time.perf_counter()
+    lines = size = 0
+    with open_log_file(file_path, gzip_backend) as file:
+        for line in file:
+            lines += 1
+            size += len(line)
+            if parse:
+                parse(line)
+    elapsed = time.perf_counter() - started_at
+    return lines / elapsed, size / elapsed
+
+
+def benchmark_gzip_backends(lines):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(temp_dir, 'benchmark.log.gz')
+        with gzip.open(file_path, 'wb') as file:
+            file.writelines(lines)
+        backends = ['gzip', 'zlib'] + [
+            name for name, command in EXTERNAL_GZIP_DECOMPRESSORS.items() if shutil.which(command[0])
+        ]
+        results = {}
+        for gzip_backend in backends:
+            results[gzip_backend] = benchmark_gzip_backend(file_path, gzip_backend)
+            results[f'{gzip_backend}+parse'] = benchmark_gzip_backend(file_path, gzip_backend, parse_record)
+        return results
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def benchmark_pipeline(log_file, config):
+    report_dir = tempfile.mkdtemp()
+    report_file_path = get_report_file_path(log_file, report_dir)
+    try:
+        started_at = time.perf_counter()
+        write_report(parse_log(log_file, config), report_file_path, config)
+        uninstrumented_time = time.perf_counter() - started_at
+
+        stats = RunStats()
+        report_data = parse_log(log_file, config, stats)
+        write_report(report_data, report_file_path, config, stats)
+        stats.counters['log_bytes'] = os.path.getsize(log_file.path)
+        result = stats.to_dict()
+        result['uninstrumented_time'] = uninstrumented_time
+        result['end_to_end_lines_per_sec'] = result['lines'] / uninstrumented_time
+        return result
+    finally:
+        shutil.rmtree(report_dir)
+
+
+def run_pipeline_benchmark(args):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_name = f'nginx-access-ui.log-{LOG_DATE:%Y%m%d}{".gz" if args.gzip else ""}'
+        log_file = LogFile(os.path.join(temp_dir, file_name), LOG_DATE)
+        started_at = time.perf_counter()
+        generate_log(log_file.path, args.lines, args.urls, args.zipf, args.error_fraction, args.seed)
+        generation_time = time.perf_counter() - started_at
+        config = get_config(log_analyzer.config, {
+            'ERROR_LIMIT': 100,
+            'WORKERS': args.workers,
+            'REPORT_TEMPLATE_PATH': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report.html'),
+        })
+        result = benchmark_pipeline(log_file, config)
+    finally:
+        shutil.rmtree(temp_dir)
+    return {
+        'generator': {
+            'lines': args.lines,
+            'urls': args.urls,
+            'zipf': args.zipf,
+            'error_fraction': args.error_fraction,
+            'gzip': args.gzip,
+            'seed': args.seed,
+            'generation_time': generation_time,
+        },
+        'workers': args.workers,
+        **result,
+    }
+
+
+def print_results(results, baseline):
+    for name, lines_per_second in results.items():
+        print(f'{name:>12}: {lines_per_second:12.0f} lines/sec ({lines_per_second / results[baseline]:.2f}x)')
+
+
+def main():
+    args = get_args()
+    if args.target == 'pipeline':
+        result = json.dumps(run_pipeline_benchmark(args), indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(result)
+        print(result)
+        return
+    lines = read_lines(args.log, args.repeat)
+    if args.target == 'gzip':
+        results = benchmark_gzip_backends(lines)
+        for name, (lines_per_second, bytes_per_second) in results.items():
+            baseline = results['gzip+parse' if name.endswith('+parse') else 'gzip'][0]
+            print(
+                f'{name:>12}: {lines_per_second:12.0f} lines/sec {bytes_per_second / 1024 / 1024:8.1f} MB/sec '
+                f'({lines_per_second / baseline:.2f}x)'
+            )
+        return
+    print_results(benchmark_parsers(lines), 'groupdict')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,40 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import cProfile
 import gzip
+import heapq
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
+import queue
 import re
-import statistics
-from collections import defaultdict, namedtuple
-from datetime import datetime
+import resource
+import shutil
+import subprocess
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
 from string import Template
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+FOLLOW_READ_SIZE = 16 * 1024 * 1024
+INCREMENTAL_QUANTILE_ERROR = 0.01
+PERCENTILES_QUANTILE_ERROR = 0.01
+
 config = {
     'REPORT_SIZE': 1000,
     'REPORT_DIR': './reports',
@@ -20,6 +44,30 @@ config = {
     'LOGGING_FILE_PATH': './parser.log',
     'ERROR_LIMIT': 20,
     'REPORT_PRECISION': 3,
+    'WORKERS': 1,
+    'CHUNK_SIZE': DEFAULT_CHUNK_SIZE,
+    # None keeps every request time for exact medians, or uses a 0.01 sketch with REPORT_PERCENTILES; 0 is always exact
+    'QUANTILE_ERROR': None,
+    'INCREMENTAL': False,
+    'LINE_PARSER': 'fast',
+    'DATE_FROM': None,
+    'DATE_TO': None,
+    'DAYS': None,
+    'COLUMNAR': False,
+    'URL_STRIP_QUERY': False,
+    'URL_COLLAPSE_IDS': False,
+    'URL_RULES': [],
+    'MAX_URLS': None,
+    'FOLLOW': False,
+    'FOLLOW_WINDOWS': [1, 5, 60],
+    'FOLLOW_POLL_INTERVAL': 1,
+    'FOLLOW_REPORT_INTERVAL': 60,
+    'STATS': False,
+    'PROFILE': False,
+    'GZIP_BACKEND': 'auto',
+    'REPORT_SIDECAR': False,
+    'REPORT_PERCENTILES': [],
+    'REPORT_STATUS_COUNTS': False,
 }
 
 line_pattern = re.compile(
@@ -38,21 +86,664 @@ line_pattern = re.compile(
 )
 
 LogFile = namedtuple('LogFile', ['path', 'date'])
+ReportState = namedtuple('ReportState', ['offset', 'counters', 'report_data'])
+LogRecord = namedtuple('LogRecord', ['path', 'request_time', 'status'])
+# namedtuple(defaults=...) needs python3.7
+LogRecord.__new__.__defaults__ = (None,)
+ColumnStats = namedtuple('ColumnStats', ['count', 'time_sum', 'time_max', 'time_med'])
+ParseOptions = namedtuple('ParseOptions', ['quantile_error', 'line_parser', 'normalizer', 'max_urls', 'gzip_backend'])
+ParseOptions.__new__.__defaults__ = (None, 'fast', None, None, 'auto')
+
+EXTERNAL_GZIP_DECOMPRESSORS = {
+    'igzip': ['igzip', '-dc'],
+    'pigz': ['pigz', '-dc'],
+}
+
+
+class UrlNormalizer:
+    NUMBER_PATTERN = re.compile(r'(?<=/)\d+(?=/|$)')
+    UUID_PATTERN = re.compile(r'(?<=/)[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}(?=/|$)')
+
+    def __init__(self, strip_query=False, collapse_ids=False, rules=()):
+        self.strip_query = strip_query
+        self.collapse_ids = collapse_ids
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in rules]
+
+    def __call__(self, path):
+        if self.strip_query:
+            path = path.partition('?')[0]
+        if self.collapse_ids:
+            path = self.NUMBER_PATTERN.sub('{id}', self.UUID_PATTERN.sub('{uuid}', path))
+        for pattern, replacement in self.rules:
+            path = pattern.sub(replacement, path)
+        return path
+
+    def to_dict(self):
+        return {
+            'strip_query': self.strip_query,
+            'collapse_ids': self.collapse_ids,
+            'rules': [[pattern.pattern, replacement] for pattern, replacement in self.rules],
+        }
+
+
+class BoundedReportData(dict):
+    """
+    Per-URL stats limited to `max_size` keys with the weighted Space-Saving
+    algorithm: a new URL replaces the one with the smallest time_sum and
+    inherits it as `errors[url]`, an upper bound of its missed time. Evicted
+    requests are still counted in the totals.
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+        self.evicted_count = 0
+        self.evicted_time = 0
+        self.errors = {}
+        self._heap = []
+
+    def __setitem__(self, url, stats):
+        if url not in self:
+            if len(self) >= self.max_size:
+                self.errors[url] = self._evict()
+            heapq.heappush(self._heap, (self._get_weight(url, stats), url))
+        super().__setitem__(url, stats)
+
+    def __reduce__(self):
+        return _restore_bounded_report_data, (
+            self.max_size, dict(self), self.evicted_count, self.evicted_time, self.errors
+        )
+
+    def _get_weight(self, url, stats):
+        return stats.time_sum + self.errors.get(url, 0)
+
+    def _evict(self):
+        while True:
+            weight, url = heapq.heappop(self._heap)
+            current_weight = self._get_weight(url, self[url])
+            if current_weight > weight:
+                heapq.heappush(self._heap, (current_weight, url))
+                continue
+            stats = self.pop(url)
+            self.errors.pop(url, None)
+            self.evicted_count += stats.count
+            self.evicted_time += stats.time_sum
+            return weight
+
+
+def _restore_bounded_report_data(max_size, items, evicted_count, evicted_time, errors):
+    report_data = BoundedReportData(max_size)
+    report_data.errors.update(errors)
+    for url, stats in items.items():
+        report_data[url] = stats
+    report_data.evicted_count = evicted_count
+    report_data.evicted_time = evicted_time
+    return report_data
+
+
+def create_report_data(max_urls=None):
+    return BoundedReportData(int(max_urls)) if max_urls else {}
+
+
+def get_evicted_totals(report_data):
+    return getattr(report_data, 'evicted_count', 0), getattr(report_data, 'evicted_time', 0)
+
+
+class ExactQuantiles:
+    __slots__ = ('values', 'is_sorted')
+
+    def __init__(self):
+        self.values = []
+        self.is_sorted = True
+
+    def add(self, value):
+        self.values.append(value)
+        self.is_sorted = False
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        self.is_sorted = False
+
+    def quantile(self, q):
+        if not self.values:
+            return 0
+        if not self.is_sorted:
+            self.values.sort()
+            self.is_sorted = True
+        rank = q * (len(self.values) - 1)
+        lower = math.floor(rank)
+        upper = math.ceil(rank)
+        fraction = rank - lower
+        return self.values[lower] * (1 - fraction) + self.values[upper] * fraction
+
+    def to_dict(self):
+        return {'values': self.values}
+
+    @classmethod
+    def from_dict(cls, data):
+        quantiles = cls()
+        quantiles.values = data['values']
+        quantiles.is_sorted = False
+        return quantiles
+
+
+class QuantileSketch:
+    """
+    Mergeable log-bucketed quantile sketch (DDSketch): every returned quantile
+    is within `relative_error` of the exact value, memory depends only on the
+    range of values, not on their count.
+    """
+    __slots__ = ('relative_error', 'log_gamma', 'buckets', 'zero_count', 'count')
+
+    def __init__(self, relative_error):
+        self.relative_error = relative_error
+        self.log_gamma = math.log((1 + relative_error) / (1 - relative_error))
+        self.buckets = Counter()
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        self.buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.zero_count += other.zero_count
+        self.buckets.update(other.buckets)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0
+        rank = q * (self.count - 1)
+        lower = self._value_at_rank(math.floor(rank))
+        upper = self._value_at_rank(math.ceil(rank))
+        fraction = rank - math.floor(rank)
+        return lower * (1 - fraction) + upper * fraction
+
+    def _value_at_rank(self, rank):
+        seen = self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        return 2 * math.exp(index * self.log_gamma) / (1 + math.exp(self.log_gamma))
+
+    def to_dict(self):
+        return {
+            'relative_error': self.relative_error,
+            'buckets': {str(index): count for index, count in self.buckets.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_error'])
+        sketch.buckets = Counter({int(index): count for index, count in data['buckets'].items()})
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        return sketch
+
+
+class ReportColumns:
+    def __init__(self, urls, counts, time_sums, time_maxes, time_medians, time_percentiles=None, status_counts=None):
+        self.urls = urls
+        self.counts = counts
+        self.time_sums = time_sums
+        self.time_maxes = time_maxes
+        self.time_medians = time_medians
+        self.time_percentiles = time_percentiles or {}
+        self.status_counts = status_counts or {}
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(self.urls)
+
+    def values(self):
+        for index in range(len(self.urls)):
+            yield ColumnStats(
+                int(self.counts[index]), float(self.time_sums[index]),
+                float(self.time_maxes[index]), float(self.time_medians[index])
+            )
+
+    def items(self):
+        return zip(self.urls, self.values())
+
+
+class LazyQuantiles:
+    def __init__(self, stats_list, q):
+        self.stats_list = stats_list
+        self.q = q
+
+    def __getitem__(self, index):
+        return self.stats_list[index].quantiles.quantile(self.q)
+
+
+class RequestTimeStats:
+    __slots__ = ('count', 'time_sum', 'time_max', 'quantiles', 'count_4xx', 'count_5xx')
+
+    def __init__(self, quantile_error=None):
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.quantiles = QuantileSketch(quantile_error) if quantile_error else ExactQuantiles()
+        self.count_4xx = 0
+        self.count_5xx = 0
+
+    def add(self, request_time, status=None):
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        self.quantiles.add(request_time)
+        if status is not None and status >= 400:
+            if status < 500:
+                self.count_4xx += 1
+            elif status < 600:
+                self.count_5xx += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.quantiles.merge(other.quantiles)
+        self.count_4xx += other.count_4xx
+        self.count_5xx += other.count_5xx
+        return self
+
+    @property
+    def time_med(self):
+        return self.quantiles.quantile(0.5)
+
+    @property
+    def status_counts(self):
+        return {'4xx': self.count_4xx, '5xx': self.count_5xx}
+
+    def get_time_percentiles(self, percentiles):
+        return {percentile: self.quantiles.quantile(percentile / 100) for percentile in percentiles}
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'time_sum': self.time_sum,
+            'time_max': self.time_max,
+            'quantiles': self.quantiles.to_dict(),
+            'count_4xx': self.count_4xx,
+            'count_5xx': self.count_5xx,
+        }
+
+    @classmethod
+    def from_dict(cls, data, quantile_error=None):
+        stats = cls(quantile_error)
+        stats.count = data['count']
+        stats.time_sum = data['time_sum']
+        stats.time_max = data['time_max']
+        stats.count_4xx = data.get('count_4xx', 0)
+        stats.count_5xx = data.get('count_5xx', 0)
+        stats.quantiles = stats.quantiles.from_dict(data['quantiles'])
+        return stats
+
+
+class RunStats:
+    """
+    Collects exclusive wall time per stage: time spent in a nested stage is
+    not counted for the enclosing one, so lazily chained generators (reading,
+    parsing, aggregation) are measured separately.
+    """
+
+    def __init__(self):
+        self.stage_times = Counter()
+        self.counters = Counter()
+        self.started_at = time.perf_counter()
+        self._child_times = []
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        self._child_times.append(0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self.stage_times[name] += elapsed - self._child_times.pop()
+            if self._child_times:
+                self._child_times[-1] += elapsed
+
+    def iterate(self, name, iterable, count_bytes=False):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            if count_bytes:
+                self.counters['bytes'] += len(item)
+            yield item
+
+    def to_dict(self):
+        total_time = time.perf_counter() - self.started_at
+        parse_time = sum(self.stage_times[stage] for stage in ('reading', 'decompression', 'parsing', 'aggregation'))
+        return {
+            'total_time': total_time,
+            'stages': dict(self.stage_times),
+            'lines': self.counters['lines'],
+            'errors': self.counters['errors'],
+            'bytes': self.counters['bytes'],
+            'log_bytes': self.counters['log_bytes'],
+            'lines_per_sec': self.counters['lines'] / parse_time if parse_time else None,
+            'bytes_per_sec': self.counters['bytes'] / parse_time if parse_time else None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+class NullStats:
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def iterate(self, name, iterable, count_bytes=False):
+        return iterable
+
+
+NULL_STATS = NullStats()
+
+
+class ThreadedGzipReader:
+    """
+    Decompresses a .gz file with zlib in a background thread, keeping at
+    most `read_ahead` decompressed blocks ahead of the reader. zlib releases
+    the GIL, so decompression overlaps with parsing.
+    """
+
+    def __init__(self, file_path, block_size=1024 * 1024, read_ahead=8):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=read_ahead)
+        self.buffer = b''
+        self.is_finished = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _decompress(self):
+        try:
+            for block, _ in read_gzip_members(self.file_path, block_size=self.block_size, is_complete=True):
+                if block and not self._put(block):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get_block(self):
+        if self.is_finished:
+            return None
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            raise block
+        if block is None:
+            self.is_finished = True
+        return block
+
+    def read(self, size=-1):
+        blocks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            block = self._get_block()
+            if block is None:
+                break
+            blocks.append(block)
+            length += len(block)
+        self.buffer = b''
+        if 0 <= size < length:
+            # only the last block is split, so every byte is copied once
+            last_block = blocks.pop()
+            split_at = len(last_block) - (length - size)
+            blocks.append(last_block[:split_at])
+            self.buffer = last_block[split_at:]
+        return b''.join(blocks)
+
+    def __iter__(self):
+        while True:
+            block = self._get_block()
+            if block is None:
+                break
+            data = self.buffer + block
+            last_line_end = data.rfind(b'\n') + 1
+            self.buffer = data[last_line_end:]
+            yield from io.BytesIO(data[:last_line_end])
+        if self.buffer:
+            yield self.buffer
+            self.buffer = b''
+
+
+class ExternalGzipReader:
+    def __init__(self, command, file_path):
+        self.process = subprocess.Popen([*command, file_path], stdout=subprocess.PIPE, bufsize=1024 * 1024)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.process.stdout.close()
+        return_code = self.process.wait()
+        if exc_type is None and return_code:
+            raise RuntimeError(f'Decompressor {self.process.args[0]} failed with code {return_code}')
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+
+def get_gzip_backend(gzip_backend='auto'):
+    if gzip_backend != 'auto':
+        return gzip_backend
+    for name, command in EXTERNAL_GZIP_DECOMPRESSORS.items():
+        if shutil.which(command[0]):
+            return name
+    return 'zlib'
+
+
+class LogTailer:
+    def __init__(self, log_dir, read_size=FOLLOW_READ_SIZE):
+        self.log_dir = log_dir
+        self.read_size = read_size
+        self.path = None
+        self.file = None
+        self.inode = None
+        self.tail = b''
+
+    def open(self, path, from_end=False):
+        self.close()
+        self.path = path
+        self.file = open_log_file(path, 'gzip')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if from_end and path.endswith('.gz'):
+            # gzip files cannot seek to the end, so skip the existing data block by block
+            while self.file.read(self.read_size):
+                pass
+        elif from_end:
+            self.file.seek(0, os.SEEK_END)
+        logging.info(f'Following log file "{path}"')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+        self.tail = b''
+
+    def read_lines(self):
+        last_log_file = get_last_log_file(self.log_dir)
+        if not self.file:
+            if last_log_file:
+                self.open(last_log_file.path, from_end=True)
+            return []
+        lines, is_drained = self._read_available()
+        if not is_drained:
+            return lines
+        if last_log_file and last_log_file.path != self.path:
+            if self.tail:
+                lines.append(self.tail)
+            self.open(last_log_file.path)
+        elif self._is_replaced():
+            self.open(self.path)
+        return lines
+
+    def _read_available(self):
+        block = self.file.read(self.read_size)
+        data = self.tail + block
+        last_line_end = data.rfind(b'\n') + 1
+        self.tail = data[last_line_end:]
+        return data[:last_line_end].splitlines(keepends=True), len(block) < self.read_size
+
+    def _is_replaced(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self.inode or (not self.path.endswith('.gz') and stat.st_size < self.file.tell())
+
+
+class RollingWindows:
+    def __init__(self, windows, options=ParseOptions()):
+        self.windows = sorted(windows)
+        self.options = options
+        self.buckets = {}
+
+    def add(self, records, now):
+        minute = int(now // 60)
+        bucket = self.buckets.get(minute)
+        if bucket is None:
+            bucket = self.buckets[minute] = create_report_data(self.options.max_urls)
+        aggregate_records(records, self.options, bucket)
+        for expired_minute in [bucket_minute for bucket_minute in self.buckets
+                               if bucket_minute <= minute - self.windows[-1]]:
+            del self.buckets[expired_minute]
+
+    def get_report_data(self, window, now):
+        minute = int(now // 60)
+        report_data = create_report_data(self.options.max_urls)
+        for bucket_minute, bucket in self.buckets.items():
+            if bucket_minute <= minute - window:
+                continue
+            for url, stats in bucket.items():
+                window_stats = report_data.get(url)
+                if window_stats is None:
+                    window_stats = report_data[url] = RequestTimeStats(self.options.quantile_error)
+                window_stats.merge(stats)
+        return report_data
 
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--from', dest='date_from', help='first log date, YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', help='last log date, YYYY-MM-DD')
+    parser.add_argument('--days', type=int, help='number of days up to --to or the last log date')
+    parser.add_argument('--columnar', action='store_true', help='convert the log to columns and report from them')
+    parser.add_argument('--follow', action='store_true', help='tail the last log and keep rolling reports')
+    parser.add_argument('--stats', action='store_true', help='save per-stage timings next to the report')
+    parser.add_argument('--profile', action='store_true', help='save timings and a cProfile dump next to the report')
     return parser.parse_args()
 
 
-def save_report(report_data, report_file_path, report_template_path):
+def get_args_config(args):
+    args_config = {}
+    if args.workers:
+        args_config['WORKERS'] = args.workers
+    if args.incremental:
+        args_config['INCREMENTAL'] = True
+    if args.date_from:
+        args_config['DATE_FROM'] = args.date_from
+    if args.date_to:
+        args_config['DATE_TO'] = args.date_to
+    if args.days:
+        args_config['DAYS'] = args.days
+    if args.columnar:
+        args_config['COLUMNAR'] = True
+    if args.follow:
+        args_config['FOLLOW'] = True
+    if args.stats:
+        args_config['STATS'] = True
+    if args.profile:
+        args_config['PROFILE'] = True
+    return args_config
+
+
+def split_template(template_data, placeholder='table_json'):
+    for matched in Template.pattern.finditer(template_data):
+        if placeholder in (matched.group('named'), matched.group('braced')):
+            return (
+                Template(template_data[:matched.start()]).safe_substitute({}),
+                Template(template_data[matched.end():]).safe_substitute({}),
+            )
+    return Template(template_data).safe_substitute({}), None
+
+
+def write_json_rows(file, rows, compact=False):
+    item_separator, key_separator = (',', ':') if compact else (', ', ': ')
+    file.write('[')
+    for index, row in enumerate(rows):
+        if index:
+            file.write(item_separator)
+        file.write(json.dumps(row, separators=(item_separator, key_separator)))
+    file.write(']')
+
+
+def get_sidecar_file_path(report_file_path):
+    return f'{os.path.splitext(report_file_path)[0]}.json'
+
+
+def save_report(report_data, report_file_path, report_template_path, sidecar=False):
     with open(report_template_path, 'r') as f:
-        file_data = f.read()
+        head, tail = split_template(f.read())
 
-    file_data = Template(file_data).safe_substitute({'table_json': json.dumps(report_data)})
-    with open(report_file_path, 'w') as f:
-        f.write(file_data)
+    if sidecar:
+        sidecar_file_path = get_sidecar_file_path(report_file_path)
+        with open(f'{sidecar_file_path}.tmp', 'w') as f:
+            write_json_rows(f, report_data, compact=True)
+        os.replace(f'{sidecar_file_path}.tmp', sidecar_file_path)
+
+    temp_file_path = f'{report_file_path}.tmp'
+    with open(temp_file_path, 'w') as f:
+        f.write(head)
+        if tail is not None:
+            if sidecar:
+                f.write(json.dumps(os.path.basename(sidecar_file_path)))
+            else:
+                write_json_rows(f, report_data)
+            f.write(tail)
+    os.replace(temp_file_path, report_file_path)
 
 
 def parse_line(line):
@@ -60,67 +751,642 @@ def parse_line(line):
     return matched.groupdict() if matched else None
 
 
-def get_calculated_report_data(report_data, report_size, report_precision):
-    template_data = []
-    requests_count = sum(map(len, report_data.values()))
-    requests_time = sum(map(sum, report_data.values()))
-
-    for url, request_time_list in report_data.items():
-        current_request_count = len(request_time_list)
-        current_request_time = sum(request_time_list)
-        template_data.append({
-            'url': url,
-            'count': current_request_count,
-            'count_perc': round(100 * current_request_count / requests_count, report_precision),
-            'time_sum': round(current_request_time, report_precision),
-            'time_perc': round(100 * current_request_time / requests_time, report_precision),
-            'time_avg': round(current_request_time / current_request_count, report_precision),
-            'time_max': round(max(request_time_list), report_precision),
-            'time_med': round(statistics.median(request_time_list), report_precision)
-        })
-
-    if len(template_data) > int(report_size):
+def tokenize_line(line):
+    request_start = line.find(b'] "') + 3
+    if request_start < 3:
+        return None
+    request_end = line.find(b'" ', request_start)
+    time_start = line.rfind(b'" ') + 2
+    if request_end < 0 or time_start <= request_end + 2:
+        return None
+    path_start = line.find(b' ', request_start, request_end) + 1
+    if not path_start:
+        return None
+    path_end = line.find(b' HTTP/', path_start, request_end)
+    if path_end < 0:
+        path_end = request_end
+    try:
+        request_time = float(line[time_start:])
+    except ValueError:
+        return None
+    status = line[request_end + 2:line.find(b' ', request_end + 2)]
+    return LogRecord(line[path_start:path_end].decode('utf-8'), request_time, get_status_code(status))
+
+
+def get_status_code(status):
+    return int(status) if status.isdigit() else None
+
+
+def parse_record_regex(line):
+    parsed_line = parse_line(line.decode('utf-8'))
+    if not parsed_line:
+        return None
+    return LogRecord(
+        parsed_line['path'], float(parsed_line['request_time']), get_status_code(parsed_line['status'])
+    )
+
+
+def parse_record(line):
+    return tokenize_line(line) or parse_record_regex(line)
+
+
+def parse_record_validated(line):
+    record = parse_record_regex(line)
+    if tokenize_line(line) not in (None, record):
+        logging.warning(f'Fast tokenizer mismatch on line: {line!r}')
+    return record
+
+
+def tokenize_line_columns(line):
+    record = tokenize_line(line)
+    if not record:
+        parsed_line = parse_line(line.decode('utf-8'))
+        if not parsed_line:
+            return None
+        record = LogRecord(parsed_line['path'], float(parsed_line['request_time']))
+        return record, parsed_line['status'], f'{parsed_line["date"]} {parsed_line["timezone"]}'
+    date_start = line.find(b'[') + 1
+    date_end = line.find(b'] "')
+    status_start = line.find(b'" ', date_end + 3) + 2
+    status_end = line.find(b' ', status_start)
+    return record, line[status_start:status_end], line[date_start:date_end].decode('utf-8')
+
+
+LINE_PARSERS = {
+    'fast': parse_record,
+    'regex': parse_record_regex,
+    'validate': parse_record_validated,
+}
+
+
+def get_report_row(url, count, time_sum, time_max, time_med, requests_count, requests_time, report_precision,
+                   time_percentiles=None, status_counts=None):
+    row = {
+        'url': url,
+        'count': count,
+        'count_perc': round(100 * count / requests_count, report_precision),
+        'time_sum': round(time_sum, report_precision),
+        'time_perc': round(100 * time_sum / requests_time, report_precision),
+        'time_avg': round(time_sum / count, report_precision),
+        'time_max': round(time_max, report_precision),
+        'time_med': round(time_med, report_precision)
+    }
+    for percentile, value in (time_percentiles or {}).items():
+        row[f'time_p{percentile:g}'] = round(value, report_precision)
+    for status_class, status_count in (status_counts or {}).items():
+        row[f'count_{status_class}'] = status_count
+    return row
+
+
+def get_calculated_report_data_python(report_data, report_size, report_precision, percentiles=(), status_counts=False):
+    evicted_count, evicted_time = get_evicted_totals(report_data)
+    requests_count = sum(stats.count for stats in report_data.values()) + evicted_count
+    requests_time = sum(stats.time_sum for stats in report_data.values()) + evicted_time
+
+    urls = list(report_data)
+    if len(urls) > int(report_size):
         logging.info(f'Cutting log size to {report_size}')
-        template_data.sort(key=lambda item: item['time_sum'], reverse=True)
-        return template_data[:int(report_size)]
+        urls.sort(key=lambda url: round(report_data[url].time_sum, report_precision), reverse=True)
+        urls = urls[:int(report_size)]
 
+    template_data = []
+    for url in urls:
+        stats = report_data[url]
+        template_data.append(get_report_row(
+            url, stats.count, stats.time_sum, stats.time_max, stats.time_med,
+            requests_count, requests_time, report_precision,
+            stats.get_time_percentiles(percentiles), stats.status_counts if status_counts else None
+        ))
     return template_data
 
 
+def get_top_indexes(time_sums, report_size, report_precision):
+    size = len(time_sums)
+    kth_time_sum = time_sums[np.argpartition(time_sums, size - report_size)[size - report_size]]
+    tolerance = 10 ** -report_precision if report_precision is not None else 1
+    candidates = np.flatnonzero(time_sums >= kth_time_sum - tolerance).tolist()
+    rounded_time_sums = {index: round(float(time_sums[index]), report_precision) for index in candidates}
+    candidates.sort(key=lambda index: -rounded_time_sums[index])
+    return candidates[:report_size]
+
+
+def get_report_columns(report_data, percentiles=(), status_counts=False):
+    stats_list = list(report_data.values())
+    return ReportColumns(
+        list(report_data),
+        np.fromiter((stats.count for stats in stats_list), dtype=np.int64, count=len(stats_list)),
+        np.fromiter((stats.time_sum for stats in stats_list), dtype=np.float64, count=len(stats_list)),
+        np.fromiter((stats.time_max for stats in stats_list), dtype=np.float64, count=len(stats_list)),
+        LazyQuantiles(stats_list, 0.5),
+        {percentile: LazyQuantiles(stats_list, percentile / 100) for percentile in percentiles},
+        {
+            '4xx': [stats.count_4xx for stats in stats_list],
+            '5xx': [stats.count_5xx for stats in stats_list],
+        } if status_counts else None,
+    )
+
+
+def get_calculated_report_data_numpy(report_data, report_size, report_precision, percentiles=(), status_counts=False):
+    evicted_count, evicted_time = get_evicted_totals(report_data)
+    if not isinstance(report_data, ReportColumns):
+        report_data = get_report_columns(report_data, percentiles, status_counts)
+    urls, counts, time_sums, time_maxes = (
+        report_data.urls, report_data.counts, report_data.time_sums, report_data.time_maxes
+    )
+
+    requests_count = int(counts.sum()) + evicted_count
+    requests_time = sum(time_sums.tolist()) + evicted_time
+    report_size = int(report_size)
+    if len(urls) > report_size:
+        logging.info(f'Cutting log size to {report_size}')
+        indexes = get_top_indexes(time_sums, report_size, report_precision)
+    else:
+        indexes = range(len(urls))
+
+    return [
+        get_report_row(
+            urls[index], int(counts[index]), float(time_sums[index]), float(time_maxes[index]),
+            float(report_data.time_medians[index]), requests_count, requests_time, report_precision,
+            {percentile: float(report_data.time_percentiles[percentile][index]) for percentile in percentiles},
+            {
+                status_class: int(status_count[index])
+                for status_class, status_count in report_data.status_counts.items()
+            } if status_counts else None,
+        )
+        for index in indexes
+    ]
+
+
+def get_calculated_report_data(report_data, report_size, report_precision, percentiles=(), status_counts=False):
+    if np is not None:
+        return get_calculated_report_data_numpy(report_data, report_size, report_precision, percentiles, status_counts)
+    return get_calculated_report_data_python(report_data, report_size, report_precision, percentiles, status_counts)
+
+
+def get_log_date(log_name):
+    matched = re.match('^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$', log_name)
+    if not matched:
+        return None
+    try:
+        return datetime.strptime(matched.group('date'), '%Y%m%d')
+    except ValueError:
+        return None
+
+
 def get_last_log_file(log_dir):
     if not os.path.isdir(log_dir):
         raise NotADirectoryError
     last_log_file = None
     for log_name in os.listdir(log_dir):
-        matched = re.match('^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$', log_name)
-        if not matched:
-            continue
-        try:
-            log_date = datetime.strptime(matched.group('date'), '%Y%m%d')
-        except ValueError:
+        log_date = get_log_date(log_name)
+        if not log_date:
             continue
         if not last_log_file or last_log_file.date < log_date:
             last_log_file = LogFile(os.path.join(log_dir, log_name), log_date)
     return last_log_file
 
 
-def parse_file(file_path, error_limit):
-    open_file = gzip.open if file_path.endswith('.gz') else open
-    lines = 0
-    errors = 0
-    with open_file(file_path, 'rb') as file:
-        for line in file:
-            lines += 1
-            result = parse_line(line.decode('utf-8'))
-            if not result:
-                errors += 1
-                continue
-            yield result
-    errors_percent = round(errors * 100 / lines)
+def get_log_files(log_dir, date_from=None, date_to=None):
+    if not os.path.isdir(log_dir):
+        raise NotADirectoryError
+    log_files = {}
+    for log_name in sorted(os.listdir(log_dir)):
+        log_date = get_log_date(log_name)
+        if not log_date or log_date in log_files:
+            continue
+        if (date_from and log_date < date_from) or (date_to and log_date > date_to):
+            continue
+        log_files[log_date] = LogFile(os.path.join(log_dir, log_name), log_date)
+    return [log_files[log_date] for log_date in sorted(log_files)]
+
+
+def open_log_file(file_path, gzip_backend='auto'):
+    if not file_path.endswith('.gz'):
+        return open(file_path, 'rb')
+    gzip_backend = get_gzip_backend(gzip_backend)
+    if gzip_backend == 'zlib':
+        return ThreadedGzipReader(file_path)
+    if gzip_backend in EXTERNAL_GZIP_DECOMPRESSORS:
+        return ExternalGzipReader(EXTERNAL_GZIP_DECOMPRESSORS[gzip_backend], file_path)
+    return gzip.open(file_path, 'rb')
+
+
+def parse_lines(lines, counters, line_parser='fast'):
+    parse = LINE_PARSERS[line_parser]
+    for line in lines:
+        counters['lines'] += 1
+        record = parse(line)
+        if not record:
+            counters['errors'] += 1
+            continue
+        yield record
+
+
+def check_errors_limit(counters, error_limit):
+    if not counters['lines']:
+        return
+    errors_percent = round(counters['errors'] * 100 / counters['lines'])
     if errors_percent > error_limit:
         raise RuntimeError(f'Percent of errors is more than expected: {errors_percent}')
 
 
+def parse_file(file_path, error_limit, line_parser='fast', stats=NULL_STATS, gzip_backend='auto'):
+    counters = Counter()
+    with open_log_file(file_path, gzip_backend) as file:
+        lines = stats.iterate('decompression' if file_path.endswith('.gz') else 'reading', file, count_bytes=True)
+        yield from stats.iterate('parsing', parse_lines(lines, counters, line_parser))
+    check_errors_limit(counters, error_limit)
+    if isinstance(stats, RunStats):
+        stats.counters.update(counters)
+
+
+def aggregate_parsed_lines(records, quantile_error=None, report_data=None):
+    if report_data is None:
+        report_data = {}
+    for record in records:
+        stats = report_data.get(record.path)
+        if stats is None:
+            stats = report_data[record.path] = RequestTimeStats(quantile_error)
+        stats.add(record.request_time, record.status)
+    return report_data
+
+
+def aggregate_records(records, options, report_data=None):
+    if report_data is None:
+        report_data = create_report_data(options.max_urls)
+    if options.normalizer:
+        records = (record._replace(path=options.normalizer(record.path)) for record in records)
+    return aggregate_parsed_lines(records, options.quantile_error, report_data)
+
+
+def merge_report_data(report_data, partial_report_data):
+    for url, stats in partial_report_data.items():
+        if url in report_data:
+            report_data[url].merge(stats)
+        else:
+            report_data[url] = stats
+    if isinstance(report_data, BoundedReportData):
+        evicted_count, evicted_time = get_evicted_totals(partial_report_data)
+        report_data.evicted_count += evicted_count
+        report_data.evicted_time += evicted_time
+    return report_data
+
+
+def get_file_chunks(file_path, chunk_size, start=0, end=None):
+    if end is None:
+        end = os.path.getsize(file_path)
+    chunk_start = start
+    with open(file_path, 'rb') as file:
+        while chunk_start < end:
+            file.seek(chunk_start + chunk_size - 1)
+            file.readline()
+            chunk_end = min(file.tell(), end)
+            yield chunk_start, chunk_end
+            chunk_start = chunk_end
+
+
+def get_last_line_end(file_path, start=0, block_size=64 * 1024):
+    with open(file_path, 'rb') as file:
+        end = file.seek(0, os.SEEK_END)
+        while end > start:
+            block_start = max(end - block_size, start)
+            file.seek(block_start)
+            line_end = file.read(end - block_start).rfind(b'\n')
+            if line_end >= 0:
+                return block_start + line_end + 1
+            end = block_start
+    return start
+
+
+def read_file_range(file_path, start, end):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        position = start
+        for line in file:
+            if position >= end:
+                break
+            position += len(line)
+            yield line
+
+
+def get_decompressed_blocks(file_path, block_size, gzip_backend='auto'):
+    tail = b''
+    with open_log_file(file_path, gzip_backend) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            block = tail + block
+            last_line_end = block.rfind(b'\n') + 1
+            if not last_line_end:
+                tail = block
+                continue
+            tail = block[last_line_end:]
+            yield block[:last_line_end]
+    if tail:
+        yield tail
+
+
+def parse_chunk(chunk, options=ParseOptions()):
+    counters = Counter()
+    if isinstance(chunk, bytes):
+        lines = io.BytesIO(chunk)
+    else:
+        lines = read_file_range(*chunk)
+    report_data = aggregate_records(parse_lines(lines, counters, options.line_parser), options)
+    return report_data, counters
+
+
+def imap_bounded(pool, func, iterable, window):
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def parse_chunks_parallel(chunks, workers, options=ParseOptions(), counters=None):
+    report_data = create_report_data(options.max_urls)
+    if counters is None:
+        counters = Counter()
+    parse = partial(parse_chunk, options=options)
+    with multiprocessing.Pool(processes=workers) as pool:
+        for partial_report_data, partial_counters in imap_bounded(pool, parse, chunks, workers * 2):
+            merge_report_data(report_data, partial_report_data)
+            counters.update(partial_counters)
+    return report_data
+
+
+def parse_file_parallel(file_path, error_limit, workers, chunk_size, options=ParseOptions(), counters=None):
+    if file_path.endswith('.gz'):
+        chunks = get_decompressed_blocks(file_path, chunk_size, options.gzip_backend)
+    else:
+        chunks = ((file_path, start, end) for start, end in get_file_chunks(file_path, chunk_size))
+
+    if counters is None:
+        counters = Counter()
+    report_data = parse_chunks_parallel(chunks, workers, options, counters)
+    check_errors_limit(counters, error_limit)
+    return report_data
+
+
+def read_gzip_members(file_path, start=0, block_size=1024 * 1024, is_complete=False):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        decompressor = None
+        while True:
+            data = file.read(block_size)
+            if not data:
+                # a log being written may end inside a member, a complete one may not
+                if is_complete and decompressor is not None:
+                    raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+                break
+            while data:
+                if decompressor is None:
+                    # only zero padding may follow the last member
+                    if not data.strip(b'\x00'):
+                        return
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                block = decompressor.decompress(data)
+                if block:
+                    yield block, None
+                if not decompressor.eof:
+                    break
+                data = decompressor.unused_data
+                yield b'', file.tell() - len(data)
+                decompressor = None
+
+
+def parse_gzip_increment(file_path, offset, counters, options=ParseOptions(), is_complete=False):
+    report_data = create_report_data(options.max_urls)
+    member_data = create_report_data(options.max_urls)
+    member_counters = Counter()
+    tail = b''
+    for block, member_end in read_gzip_members(file_path, offset, is_complete=is_complete):
+        if member_end is None:
+            block = tail + block
+            last_line_end = block.rfind(b'\n') + 1
+            tail = block[last_line_end:]
+            lines = io.BytesIO(block[:last_line_end])
+            aggregate_records(parse_lines(lines, member_counters, options.line_parser), options, member_data)
+            continue
+        if tail:
+            aggregate_records(parse_lines([tail], member_counters, options.line_parser), options, member_data)
+            tail = b''
+        merge_report_data(report_data, member_data)
+        counters.update(member_counters)
+        offset = member_end
+        member_data = create_report_data(options.max_urls)
+        member_counters = Counter()
+    return report_data, offset
+
+
+def parse_file_increment(file_path, offset, counters, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, options=ParseOptions(),
+                         is_complete=False):
+    if file_path.endswith('.gz'):
+        return parse_gzip_increment(file_path, offset, counters, options, is_complete)
+    end = os.path.getsize(file_path) if is_complete else get_last_line_end(file_path, offset)
+    if workers > 1:
+        chunks = ((file_path, start, end) for start, end in get_file_chunks(file_path, chunk_size, offset, end))
+        report_data = parse_chunks_parallel(chunks, workers, options, counters)
+    else:
+        lines = read_file_range(file_path, offset, end)
+        report_data = aggregate_records(parse_lines(lines, counters, options.line_parser), options)
+    return report_data, end
+
+
+def get_state_file_path(log_file, report_dir):
+    return os.path.join(report_dir, f'.report-{log_file.date:%Y.%m.%d}.state.json')
+
+
+def load_state(state_file_path, log_file, quantile_error=None, max_urls=None, url_normalizer=None):
+    empty_state = ReportState(0, Counter(), create_report_data(max_urls))
+    if not os.path.isfile(state_file_path):
+        return empty_state
+    with open(state_file_path, 'r') as f:
+        state = json.load(f)
+    settings = (log_file.path, quantile_error, max_urls, url_normalizer.to_dict() if url_normalizer else None)
+    if (state['log_path'], state['quantile_error'], state.get('max_urls'), state.get('url_normalizer')) != settings:
+        logging.info(f'State file "{state_file_path}" does not match current settings. Starting from scratch')
+        return empty_state
+    if state['offset'] > os.path.getsize(log_file.path):
+        logging.info(f'Log file "{log_file.path}" was truncated. Starting from scratch')
+        return empty_state
+    report_data = create_report_data(max_urls)
+    if max_urls:
+        report_data.errors.update(state['url_errors'])
+        report_data.evicted_count = state['evicted_count']
+        report_data.evicted_time = state['evicted_time']
+    for url, stats in state['report_data'].items():
+        report_data[url] = RequestTimeStats.from_dict(stats, quantile_error)
+    return ReportState(state['offset'], Counter(state['counters']), report_data)
+
+
+def save_state(state_file_path, log_file, state, quantile_error=None, max_urls=None, url_normalizer=None):
+    evicted_count, evicted_time = get_evicted_totals(state.report_data)
+    temp_file_path = f'{state_file_path}.tmp'
+    with open(temp_file_path, 'w') as f:
+        json.dump({
+            'log_path': log_file.path,
+            'quantile_error': quantile_error,
+            'max_urls': max_urls,
+            'url_normalizer': url_normalizer.to_dict() if url_normalizer else None,
+            'offset': state.offset,
+            'counters': state.counters,
+            'evicted_count': evicted_count,
+            'evicted_time': evicted_time,
+            'url_errors': getattr(state.report_data, 'errors', {}),
+            'report_data': {url: stats.to_dict() for url, stats in state.report_data.items()},
+        }, f)
+    os.replace(temp_file_path, state_file_path)
+
+
+# request times are whole milliseconds, the resolution nginx logs them with; float32 would round 0.351 to 0.35
+COLUMN_TYPES = {
+    'url_id': 'I',
+    'request_time_ms': 'I',
+    'status': 'H',
+    'timestamp': 'I',
+}
+
+
+def get_columns_dir(file_path):
+    return f'{file_path}.columns'
+
+
+def parse_status(status):
+    try:
+        return int(status)
+    except ValueError:
+        return 0
+
+
+def parse_timestamp(date):
+    try:
+        return int(datetime.strptime(date, '%d/%b/%Y:%H:%M:%S %z').timestamp())
+    except ValueError:
+        return 0
+
+
+def write_columns(columns, column_files):
+    for name, column in columns.items():
+        column.tofile(column_files[name])
+        del column[:]
+
+
+def convert_to_columns(file_path, columns_dir, error_limit, block_lines=1024 * 1024, gzip_backend='auto'):
+    temp_dir = f'{columns_dir}.tmp'
+    os.makedirs(temp_dir, exist_ok=True)
+    urls = {}
+    counters = Counter()
+    columns = {name: array(type_code) for name, type_code in COLUMN_TYPES.items()}
+    column_files = {name: open(os.path.join(temp_dir, f'{name}.bin'), 'wb') for name in COLUMN_TYPES}
+    last_date = last_timestamp = None
+    try:
+        with open_log_file(file_path, gzip_backend) as file:
+            for line in file:
+                counters['lines'] += 1
+                values = tokenize_line_columns(line)
+                if not values:
+                    counters['errors'] += 1
+                    continue
+                record, status, date = values
+                if date != last_date:
+                    last_date, last_timestamp = date, parse_timestamp(date)
+                columns['url_id'].append(urls.setdefault(record.path, len(urls)))
+                columns['request_time_ms'].append(round(record.request_time * 1000))
+                columns['status'].append(parse_status(status))
+                columns['timestamp'].append(last_timestamp)
+                if len(columns['url_id']) >= block_lines:
+                    write_columns(columns, column_files)
+            write_columns(columns, column_files)
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+    check_errors_limit(counters, error_limit)
+
+    with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'log_size': os.path.getsize(file_path),
+            'log_mtime': os.path.getmtime(file_path),
+            'rows': counters['lines'] - counters['errors'],
+            'counters': counters,
+            'columns': COLUMN_TYPES,
+            'urls': list(urls),
+        }, f)
+    if os.path.isdir(columns_dir):
+        shutil.rmtree(columns_dir)
+    os.replace(temp_dir, columns_dir)
+
+
+def is_columns_fresh(columns_dir, file_path):
+    meta_file_path = os.path.join(columns_dir, 'meta.json')
+    if not os.path.isfile(meta_file_path):
+        return False
+    with open(meta_file_path, 'r') as f:
+        meta = json.load(f)
+    return (
+        meta['log_size'] == os.path.getsize(file_path) and meta['log_mtime'] == os.path.getmtime(file_path)
+        and meta['columns'] == COLUMN_TYPES
+    )
+
+
+def load_columns(columns_dir):
+    with open(os.path.join(columns_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    columns = {}
+    for name, type_code in meta['columns'].items():
+        if not meta['rows']:
+            columns[name] = np.zeros(0, dtype=type_code)
+            continue
+        columns[name] = np.memmap(
+            os.path.join(columns_dir, f'{name}.bin'), dtype=type_code, mode='r', shape=(meta['rows'],)
+        )
+    return meta, columns
+
+
+def normalize_columns(urls, url_ids, normalizer):
+    normalized_urls = {}
+    url_id_map = np.fromiter(
+        (normalized_urls.setdefault(normalizer(url), len(normalized_urls)) for url in urls),
+        dtype=url_ids.dtype, count=len(urls)
+    )
+    return list(normalized_urls), url_id_map[url_ids]
+
+
+def get_sorted_quantile(sorted_times, starts, counts, q):
+    ranks = q * (counts - 1)
+    lower = np.floor(ranks).astype(np.int64)
+    upper = np.ceil(ranks).astype(np.int64)
+    fractions = ranks - lower
+    return sorted_times[starts + lower] * (1 - fractions) + sorted_times[starts + upper] * fractions
+
+
+def aggregate_columns(urls, url_ids, request_times_ms, statuses=None, percentiles=()):
+    request_times = request_times_ms / 1000
+    counts = np.bincount(url_ids, minlength=len(urls))
+    time_sums = np.bincount(url_ids, weights=request_times, minlength=len(urls))
+    sorted_times = request_times[np.lexsort((request_times, url_ids))]
+    starts = np.cumsum(counts) - counts
+    time_maxes = sorted_times[starts + counts - 1]
+    time_medians = (sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]) / 2
+    time_percentiles = {
+        percentile: get_sorted_quantile(sorted_times, starts, counts, percentile / 100) for percentile in percentiles
+    }
+    status_counts = None
+    if statuses is not None:
+        status_classes = statuses // 100
+        status_counts = {
+            f'{status_class}xx': np.bincount(
+                url_ids, weights=status_classes == status_class, minlength=len(urls)
+            ).astype(np.int64)
+            for status_class in (4, 5)
+        }
+    return ReportColumns(urls, counts, time_sums, time_maxes, time_medians, time_percentiles, status_counts)
+
+
 def init_logging(file_name=None):
     logging.basicConfig(
         filename=file_name,
@@ -151,27 +1417,247 @@ def get_report_file_path(log_file, report_dir):
     return os.path.join(report_dir, f'report-{log_file.date:%Y.%m.%d}.html')
 
 
+def get_rollup_report_file_path(log_files, report_dir):
+    return os.path.join(report_dir, f'report-{log_files[0].date:%Y.%m.%d}-{log_files[-1].date:%Y.%m.%d}.html')
+
+
+def parse_date(value):
+    if not value or isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def get_date_range(config):
+    date_from = parse_date(config.get('DATE_FROM'))
+    date_to = parse_date(config.get('DATE_TO'))
+    days = config.get('DAYS')
+    if days and date_from:
+        raise ValueError('DATE_FROM and DAYS cannot be used together')
+    if days:
+        if not date_to:
+            last_log_file = get_last_log_file(config.get('LOG_DIR'))
+            date_to = last_log_file.date if last_log_file else datetime.now()
+        date_from = date_to - timedelta(days=int(days) - 1)
+    return date_from, date_to
+
+
+def is_range_mode(config):
+    return bool(config.get('DATE_FROM') or config.get('DATE_TO') or config.get('DAYS'))
+
+
+def get_parse_options(config):
+    quantile_error = config.get('QUANTILE_ERROR')
+    if quantile_error is None and config.get('REPORT_PERCENTILES'):
+        # exact percentiles would keep every request time of the log and sort them per URL
+        quantile_error = PERCENTILES_QUANTILE_ERROR
+    return ParseOptions(
+        quantile_error,
+        config.get('LINE_PARSER', 'fast'),
+        get_url_normalizer(config),
+        config.get('MAX_URLS'),
+        config.get('GZIP_BACKEND', 'auto'),
+    )
+
+
+def get_url_normalizer(config):
+    strip_query = config.get('URL_STRIP_QUERY', False)
+    collapse_ids = config.get('URL_COLLAPSE_IDS', False)
+    rules = config.get('URL_RULES') or []
+    if not (strip_query or collapse_ids or rules):
+        return None
+    return UrlNormalizer(strip_query, collapse_ids, rules)
+
+
+def parse_log_columnar(log_file, config, stats=NULL_STATS):
+    columns_dir = get_columns_dir(log_file.path)
+    if not is_columns_fresh(columns_dir, log_file.path):
+        logging.info(f'Converting log file "{log_file.path}" to columns "{columns_dir}"')
+        convert_to_columns(
+            log_file.path, columns_dir, config.get('ERROR_LIMIT', 100), gzip_backend=config.get('GZIP_BACKEND', 'auto')
+        )
+    meta, columns = load_columns(columns_dir)
+    check_errors_limit(Counter(meta['counters']), config.get('ERROR_LIMIT', 100))
+    if isinstance(stats, RunStats):
+        stats.counters.update(meta['counters'])
+    urls, url_ids = meta['urls'], columns['url_id']
+    normalizer = get_url_normalizer(config)
+    if normalizer:
+        urls, url_ids = normalize_columns(urls, url_ids, normalizer)
+    return aggregate_columns(
+        urls, url_ids, columns['request_time_ms'],
+        columns['status'] if config.get('REPORT_STATUS_COUNTS') else None, config.get('REPORT_PERCENTILES') or ()
+    )
+
+
+def parse_log(log_file, config, stats=NULL_STATS):
+    if config.get('COLUMNAR'):
+        if np is not None:
+            with stats.stage('parsing'):
+                return parse_log_columnar(log_file, config, stats)
+        logging.warning('NumPy is not installed, columnar mode is disabled')
+    error_limit = config.get('ERROR_LIMIT', 100)
+    workers = int(config.get('WORKERS', 1))
+    options = get_parse_options(config)
+    if workers > 1:
+        logging.info(f'Parsing log file with {workers} workers')
+        chunk_size = int(config.get('CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+        counters = Counter()
+        with stats.stage('parsing'):
+            report_data = parse_file_parallel(log_file.path, error_limit, workers, chunk_size, options, counters)
+        if isinstance(stats, RunStats):
+            stats.counters.update(counters)
+        return report_data
+    with stats.stage('aggregation'):
+        records = parse_file(log_file.path, error_limit, options.line_parser, stats, options.gzip_backend)
+        return aggregate_records(records, options)
+
+
+def parse_log_incremental(log_file, config, is_complete=False, stats=NULL_STATS):
+    options = get_parse_options(config)
+    if options.quantile_error is None:
+        # exact request times would make every run load and rewrite the whole day in the state file
+        options = options._replace(quantile_error=INCREMENTAL_QUANTILE_ERROR)
+    quantile_error = options.quantile_error
+    state_file_path = get_state_file_path(log_file, config.get('REPORT_DIR'))
+    state = load_state(state_file_path, log_file, quantile_error, options.max_urls, options.normalizer)
+    logging.info(f'Parsing log file "{log_file.path}" from offset {state.offset}')
+    previous_counters = Counter(state.counters)
+    increment_data, offset = parse_file_increment(
+        log_file.path,
+        state.offset,
+        state.counters,
+        int(config.get('WORKERS', 1)),
+        int(config.get('CHUNK_SIZE', DEFAULT_CHUNK_SIZE)),
+        options,
+        is_complete,
+    )
+    check_errors_limit(state.counters, config.get('ERROR_LIMIT', 100))
+    if isinstance(stats, RunStats):
+        stats.counters.update(state.counters - previous_counters)
+    state = ReportState(offset, state.counters, merge_report_data(state.report_data, increment_data))
+    save_state(state_file_path, log_file, state, quantile_error, options.max_urls, options.normalizer)
+    return state.report_data
+
+
+def write_report(report_data, report_file_path, config, stats=NULL_STATS):
+    with stats.stage('report_computation'):
+        report_data = get_calculated_report_data(
+            report_data, config.get('REPORT_SIZE'), config.get('REPORT_PRECISION'),
+            config.get('REPORT_PERCENTILES') or (), config.get('REPORT_STATUS_COUNTS', False)
+        )
+    with stats.stage('template_rendering'):
+        save_report(report_data, report_file_path, config.get('REPORT_TEMPLATE_PATH'), config.get('REPORT_SIDECAR'))
+    logging.info(f'Report was successfully saved: "{report_file_path}"')
+
+
+def get_stats_file_path(report_file_path, extension):
+    return f'{os.path.splitext(report_file_path)[0]}.{extension}'
+
+
+def save_stats(stats, log_file, report_file_path):
+    stats_file_path = get_stats_file_path(report_file_path, 'stats.json')
+    with open(stats_file_path, 'w') as f:
+        json.dump({'log_file': log_file.path, **stats.to_dict()}, f, indent=2)
+    logging.info(f'Stats were saved: "{stats_file_path}"')
+
+
+def parse_log_day(log_file, config, last_log_date):
+    # state files are only worth keeping with a sketch, exact request times make them as big as the log
+    if get_parse_options(config).quantile_error is None and not config.get('INCREMENTAL'):
+        # columnar results hold only final statistics and cannot be merged into the rollup
+        return parse_log(log_file, {**config, 'COLUMNAR': False})
+    return parse_log_incremental(log_file, config, is_complete=log_file.date < last_log_date)
+
+
+def run_range(config):
+    log_dir = config.get('LOG_DIR')
+    date_from, date_to = get_date_range(config)
+    log_files = get_log_files(log_dir, date_from, date_to)
+    if not log_files:
+        logging.error(f'No nginx log files from {date_from} to {date_to} were found in directory: "{log_dir}"')
+        return
+    logging.info(f'Found {len(log_files)} nginx log files in "{log_dir}"')
+
+    workers = min(int(config.get('WORKERS', 1)), len(log_files))
+    day_config = {**config, 'WORKERS': 1}
+    last_log_date = get_last_log_file(log_dir).date
+    parse_day = partial(parse_log_day, config=day_config, last_log_date=last_log_date)
+    report_dir = config.get('REPORT_DIR')
+    rollup_data = create_report_data(config.get('MAX_URLS'))
+    with multiprocessing.Pool(processes=workers) as pool:
+        for log_file, report_data in zip(log_files, pool.imap(parse_day, log_files)):
+            write_report(report_data, get_report_file_path(log_file, report_dir), config)
+            merge_report_data(rollup_data, report_data)
+
+    write_report(rollup_data, get_rollup_report_file_path(log_files, report_dir), config)
+
+
+def get_live_report_file_path(window, report_dir):
+    return os.path.join(report_dir, f'report-live-{window}m.html')
+
+
+def run_follow(config):
+    options = get_parse_options(config)
+    tailer = LogTailer(config.get('LOG_DIR'))
+    windows = RollingWindows(config.get('FOLLOW_WINDOWS', [1, 5, 60]), options)
+    poll_interval = config.get('FOLLOW_POLL_INTERVAL', 1)
+    report_interval = config.get('FOLLOW_REPORT_INTERVAL', 60)
+    counters = Counter()
+    next_report_at = time.time() + report_interval
+    while True:
+        now = time.time()
+        windows.add(parse_lines(tailer.read_lines(), counters, options.line_parser), now)
+        if now >= next_report_at:
+            logging.info(f'Parsed {counters["lines"]} lines, {counters["errors"]} errors')
+            for window in windows.windows:
+                write_report(
+                    windows.get_report_data(window, now), get_live_report_file_path(window, config.get('REPORT_DIR')),
+                    config
+                )
+            next_report_at = now + report_interval
+        time.sleep(poll_interval)
+
+
 def run(config):
     init_logging(config.get('LOGGING_FILE_PATH'))
     logging.info('Start analyzer')
+    if config.get('FOLLOW'):
+        run_follow(config)
+        return
+    if is_range_mode(config):
+        run_range(config)
+        return
+    stats = RunStats() if config.get('STATS') or config.get('PROFILE') else NULL_STATS
     log_dir = config.get('LOG_DIR')
-    log_file = get_last_log_file(log_dir)
+    with stats.stage('directory_scan'):
+        log_file = get_last_log_file(log_dir)
     if not log_file:
         logging.error(f'No nginx log file was found in directory: "{log_dir}"')
         return
     logging.info(f'Last nginx log file was found: "{log_file.path}"')
     report_file_path = get_report_file_path(log_file, config.get('REPORT_DIR'))
-    if os.path.isfile(report_file_path):
+    incremental = config.get('INCREMENTAL')
+    if os.path.isfile(report_file_path) and not incremental:
         logging.info(f'Report file "{report_file_path}" already exists. Aborting')
         return
 
-    report_data = defaultdict(list)
-    for parsed_line in parse_file(log_file.path, config.get('ERROR_LIMIT', 100)):
-        report_data[parsed_line['path']].append(float(parsed_line['request_time']))
+    profiler = cProfile.Profile() if config.get('PROFILE') else None
+    if profiler:
+        profiler.enable()
 
-    report_data = get_calculated_report_data(report_data, config.get('REPORT_SIZE'), config.get('REPORT_PRECISION'))
-    save_report(report_data, report_file_path, config.get('REPORT_TEMPLATE_PATH'))
-    logging.info(f'Report was successfully saved: "{report_file_path}"')
+    if incremental:
+        with stats.stage('parsing'):
+            report_data = parse_log_incremental(log_file, config, stats=stats)
+    else:
+        report_data = parse_log(log_file, config, stats)
+
+    write_report(report_data, report_file_path, config, stats)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(get_stats_file_path(report_file_path, 'prof'))
+    if isinstance(stats, RunStats):
+        stats.counters['log_bytes'] = os.path.getsize(log_file.path)
+        save_stats(stats, log_file, report_file_path)
 
 
 def main():
@@ -179,7 +1665,7 @@ def main():
         args = get_args()
         file_config = get_file_config(args.config)
 
-        run(get_config(config, file_config))
+        run(get_config(config, {**file_config, **get_args_config(args)}))
     except BaseException as e:
         logging.exception(e)
 
@@ -1,8 +1,53 @@
 import datetime
+import gzip
+import json
 import os
+import random
+import shutil
+import statistics
+import tempfile
 from collections import namedtuple
-from unittest import TestCase, mock
-from log_analyzer import get_config, get_last_log_file, get_file_config, run
+from functools import partial
+from string import Template
+from unittest import TestCase, mock, skipIf
+
+import log_analyzer
+from benchmark import benchmark_pipeline, generate_log
+from log_analyzer import (
+    aggregate_columns,
+    aggregate_parsed_lines,
+    aggregate_records,
+    convert_to_columns,
+    ExternalGzipReader,
+    get_calculated_report_data,
+    get_calculated_report_data_numpy,
+    get_calculated_report_data_python,
+    get_config,
+    get_date_range,
+    get_file_chunks,
+    get_file_config,
+    get_last_log_file,
+    get_parse_options,
+    is_columns_fresh,
+    load_columns,
+    LogFile,
+    LogRecord,
+    LogTailer,
+    parse_file,
+    parse_file_parallel,
+    ParseOptions,
+    parse_log_incremental,
+    parse_record_regex,
+    QuantileSketch,
+    read_gzip_members,
+    RequestTimeStats,
+    RollingWindows,
+    run,
+    save_report,
+    ThreadedGzipReader,
+    tokenize_line,
+    UrlNormalizer,
+)
 
 
 class TestLogAnalyzer(TestCase):
@@ -56,8 +101,387 @@ class TestLogAnalyzer(TestCase):
         self.assertIsNotNone(os.listdir(report_dir))
         self.remove_files_from_dir(report_dir)
 
+    def test_file_chunks(self):
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170630'
+        chunks = list(get_file_chunks(file_path, 1000))
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], os.path.getsize(file_path))
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        for start, end in chunks[:-1]:
+            self.assertEqual(data[end - 1:end], b'\n')
+
+    def test_parallel_parsing(self):
+        for file_path in ('./tests/fixtures/log/nginx-access-ui.log-20170630',
+                          './tests/fixtures/log/nginx-access-ui.log-20170826.gz'):
+            expected = get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10)), 20, 3)
+            actual = get_calculated_report_data(parse_file_parallel(file_path, 10, 3, 1000), 20, 3)
+            self.assertEqual(actual, expected)
+
+    def test_quantile_sketch(self):
+        values = [random.expovariate(1) for _ in range(10001)]
+        sketch, other_sketch = QuantileSketch(0.01), QuantileSketch(0.01)
+        for value in values[:5000]:
+            sketch.add(value)
+        for value in values[5000:]:
+            other_sketch.add(value)
+        sketch.merge(other_sketch)
+        self.assertEqual(sketch.count, len(values))
+        self.assertAlmostEqual(sketch.quantile(0.5) / statistics.median(values), 1, delta=0.01)
+
+    def test_sketch_report(self):
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170630'
+        expected = get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10)), 20, 3)
+        actual = get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10), 0.01), 20, 3)
+        for expected_row, actual_row in zip(expected, actual):
+            self.assertEqual(actual_row['time_sum'], expected_row['time_sum'])
+            self.assertAlmostEqual(actual_row['time_med'], expected_row['time_med'],
+                                   delta=expected_row['time_med'] * 0.01 + 0.001)
+
+    def test_incremental_parsing(self):
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170630'
+        with open(file_path, 'rb') as file:
+            lines = file.read().splitlines(keepends=True)
+        lines[-1] += b'\n'
+        expected = get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10), 0.01), 20, 3)
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        config = {'REPORT_DIR': temp_dir, 'ERROR_LIMIT': 10, 'INCREMENTAL': True}
+
+        log_file = LogFile(os.path.join(temp_dir, 'nginx-access-ui.log-20170630'), datetime.datetime(2017, 6, 30))
+        data = b''.join(lines)
+        for part in (data[:1000], data[1000:15000], data[15000:]):
+            with open(log_file.path, 'ab') as file:
+                file.write(part)
+            report_data = parse_log_incremental(log_file, config)
+        self.assertEqual(get_calculated_report_data(report_data, 20, 3), expected)
+        with open(os.path.join(temp_dir, '.report-2017.06.30.state.json')) as f:
+            self.assertEqual(json.load(f)['quantile_error'], 0.01)
+        normalized_data = parse_log_incremental(log_file, {**config, 'URL_STRIP_QUERY': True})
+        self.assertEqual(sum(stats.count for stats in normalized_data.values()), 100)
+        self.assertTrue(all('?' not in url for url in normalized_data))
+
+        log_file = LogFile(os.path.join(temp_dir, 'nginx-access-ui.log-20170630.gz'), datetime.datetime(2017, 6, 30))
+        for part in (lines[:10], lines[10:]):
+            with open(log_file.path, 'ab') as file:
+                file.write(gzip.compress(b''.join(part)))
+            report_data = parse_log_incremental(log_file, config)
+        self.assertEqual(get_calculated_report_data(report_data, 20, 3), expected)
+
+        # a gzip member ending exactly on a read block boundary
+        members = [gzip.compress(b''.join(lines[:10])), gzip.compress(b''.join(lines[10:]))]
+        with open(log_file.path, 'wb') as file:
+            file.write(b''.join(members))
+        config['REPORT_DIR'] = os.path.join(temp_dir, 'members')
+        os.mkdir(config['REPORT_DIR'])
+        with mock.patch('log_analyzer.read_gzip_members', partial(read_gzip_members, block_size=len(members[0]))):
+            report_data = parse_log_incremental(log_file, config)
+        self.assertEqual(get_calculated_report_data(report_data, 20, 3), expected)
+
+    def test_tokenize_line(self):
+        for file_path in ('./tests/fixtures/log/nginx-access-ui.log-20170630', './tests/fixtures/log/invalid.log'):
+            with open(file_path, 'rb') as file:
+                for line in file:
+                    self.assertEqual(tokenize_line(line), parse_record_regex(line))
+        line = b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET  HTTP/1.1" 200 9 "-" "-" "-" "-" "-" 0.5'
+        record = tokenize_line(line)
+        self.assertEqual(record, ('', 0.5, 200))
+
+    def test_range_reports(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        config = {
+            'REPORT_SIZE': 20,
+            'REPORT_DIR': temp_dir,
+            'REPORT_TEMPLATE_PATH': './report.html',
+            'LOG_DIR': './tests/fixtures/log',
+            'ERROR_LIMIT': 10,
+            'WORKERS': 2,
+            'DATE_FROM': '2017-08-01',
+            'DATE_TO': '2017-08-31',
+        }
+        run(config)
+        reports = sorted(file for file in os.listdir(temp_dir) if file.endswith('.html'))
+        self.assertEqual(reports, [
+            'report-2017.08.25-2017.08.26.html',
+            'report-2017.08.25.html',
+            'report-2017.08.26.html',
+        ])
+        self.assertFalse([file for file in os.listdir(temp_dir) if file.endswith('.state.json')])
+
+        run({**config, 'QUANTILE_ERROR': 0.01})
+        state_files = sorted(file for file in os.listdir(temp_dir) if file.endswith('.state.json'))
+        self.assertEqual(state_files, ['.report-2017.08.25.state.json', '.report-2017.08.26.state.json'])
+
+        with self.assertRaises(ValueError):
+            get_date_range({**config, 'DAYS': 7})
+
+        columnar_dir = os.path.join(temp_dir, 'columnar')
+        log_dir = os.path.join(temp_dir, 'log')
+        os.mkdir(columnar_dir)
+        os.mkdir(log_dir)
+        for file_name in ('nginx-access-ui.log-20170825', 'nginx-access-ui.log-20170826.gz'):
+            shutil.copy(os.path.join('./tests/fixtures/log', file_name), log_dir)
+        columnar_config = {**config, 'REPORT_DIR': columnar_dir, 'LOG_DIR': log_dir, 'COLUMNAR': True, 'DAYS': 3}
+        del columnar_config['DATE_FROM']
+        del columnar_config['DATE_TO']
+        run(columnar_config)
+        self.assertIn('report-2017.08.25-2017.08.26.html', os.listdir(columnar_dir))
+
+    @skipIf(log_analyzer.np is None, 'NumPy is not installed')
+    def test_columnar_report(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170826.gz'
+        columns_dir = os.path.join(temp_dir, 'columns')
+        convert_to_columns(file_path, columns_dir, 10)
+        meta, columns = load_columns(columns_dir)
+        self.assertEqual(len(columns['status']), meta['rows'])
+        expected = get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10)), 20, 3)
+        report_data = aggregate_columns(meta['urls'], columns['url_id'], columns['request_time_ms'])
+        actual = get_calculated_report_data(report_data, 20, 3)
+        self.assertEqual(actual, expected)
+
+        # float32 columns reported 0.351 as 0.35
+        file_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        with open(file_path, 'w') as f:
+            for request_time in ('0.351', '0.35', '1.001', '0.007', '123.456'):
+                f.write(
+                    f'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 927 "-" "-" "-" "-" "-" '
+                    f'{request_time}\n'
+                )
+        convert_to_columns(file_path, columns_dir, 10)
+        meta, columns = load_columns(columns_dir)
+        report_data = aggregate_columns(meta['urls'], columns['url_id'], columns['request_time_ms'], None, [90])
+        self.assertEqual(
+            get_calculated_report_data(report_data, 20, 3, [90]),
+            get_calculated_report_data(aggregate_parsed_lines(parse_file(file_path, 10)), 20, 3, [90]),
+        )
+        self.assertEqual(report_data.time_maxes[0], 123.456)
+        self.assertTrue(is_columns_fresh(columns_dir, file_path))
+        with open(os.path.join(columns_dir, 'meta.json'), 'r+') as f:
+            meta = json.load(f)
+            meta['columns'] = {'url_id': 'I', 'request_time': 'f', 'status': 'H', 'timestamp': 'I'}
+            f.seek(0)
+            f.truncate()
+            json.dump(meta, f)
+        self.assertFalse(is_columns_fresh(columns_dir, file_path))
+
+    @skipIf(log_analyzer.np is None, 'NumPy is not installed')
+    def test_numpy_report_backend(self):
+        report_data = {}
+        for index in range(500):
+            stats = report_data[f'/url/{index}'] = RequestTimeStats()
+            for _ in range(random.randint(1, 5)):
+                stats.add(random.choice([0.0005, 0.001, 0.1, 0.25, 1.2345]))
+        for report_size in (1, 10, 1000):
+            self.assertEqual(
+                get_calculated_report_data_numpy(report_data, report_size, 3),
+                get_calculated_report_data_python(report_data, report_size, 3),
+            )
+
+    def test_percentiles_and_status_counts(self):
+        records = [LogRecord('/a', index / 100, 200) for index in range(1, 101)]
+        records += [LogRecord('/a', 0.5, 404), LogRecord('/a', 0.5, 503), LogRecord('/b', 0.1)]
+        report_data = aggregate_parsed_lines(records)
+        rows = get_calculated_report_data_python(report_data, 20, 3, [90, 99], True)
+        # interpolated between the closest ranks, as statistics.quantiles(method='inclusive') does on python3.8
+        self.assertEqual((rows[0]['time_p90'], rows[0]['time_p99']), (0.899, 0.99))
+        self.assertEqual((rows[0]['count_4xx'], rows[0]['count_5xx']), (1, 1))
+        self.assertEqual((rows[1]['count_4xx'], rows[1]['count_5xx']), (0, 0))
+
+        self.assertIsNone(get_parse_options({}).quantile_error)
+        self.assertEqual(get_parse_options({'REPORT_PERCENTILES': [90]}).quantile_error, 0.01)
+        self.assertEqual(get_parse_options({'REPORT_PERCENTILES': [90], 'QUANTILE_ERROR': 0}).quantile_error, 0)
+        report_data = aggregate_records(records, get_parse_options({'REPORT_PERCENTILES': [90, 99]}))
+        self.assertIsInstance(report_data['/a'].quantiles, QuantileSketch)
+        rows = get_calculated_report_data_python(report_data, 20, 3, [90, 99], True)
+        self.assertAlmostEqual(rows[0]['time_p90'] / 0.899, 1, delta=0.02)
+        self.assertAlmostEqual(rows[0]['time_p99'] / 0.99, 1, delta=0.02)
+
+    @skipIf(log_analyzer.np is None, 'NumPy is not installed')
+    def test_percentiles_and_status_counts_backends(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170630'
+        report_data = aggregate_parsed_lines(parse_file(file_path, 10))
+        expected = get_calculated_report_data_python(report_data, 1000, 3, [90, 95, 99], True)
+        self.assertEqual(sum(row['count_4xx'] for row in expected), 9)
+        self.assertEqual(get_calculated_report_data_numpy(report_data, 1000, 3, [90, 95, 99], True), expected)
+
+        columns_dir = os.path.join(temp_dir, 'columns')
+        convert_to_columns(file_path, columns_dir, 10)
+        meta, columns = load_columns(columns_dir)
+        report_data = aggregate_columns(
+            meta['urls'], columns['url_id'], columns['request_time_ms'], columns['status'], [90, 95, 99]
+        )
+        self.assertEqual(get_calculated_report_data(report_data, 1000, 3, [90, 95, 99], True), expected)
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer(True, True, [('^/api/v2/banner/.*', '/api/v2/banner/*')])
+        self.assertEqual(normalizer('/api/1/photogenic_banners/list/?server_name=WIN7RB4'),
+                         '/api/{id}/photogenic_banners/list/')
+        self.assertEqual(normalizer('/x/123e4567-e89b-12d3-a456-426614174000/y'), '/x/{uuid}/y')
+        self.assertEqual(normalizer('/api/v2/banner/25019354'), '/api/v2/banner/*')
+        self.assertEqual(normalizer('/a/12b/'), '/a/12b/')
+
+    def test_bounded_report_data(self):
+        random.seed(1)
+        records = [LogRecord(f'/url/{int(random.paretovariate(1.1))}', random.random()) for _ in range(50000)]
+        expected = get_calculated_report_data(aggregate_parsed_lines(records), 10, 3)
+        report_data = aggregate_records(records, ParseOptions(max_urls=100))
+        self.assertEqual(len(report_data), 100)
+        actual = get_calculated_report_data(report_data, 10, 3)
+        self.assertEqual([row['url'] for row in actual], [row['url'] for row in expected])
+        self.assertEqual([row['count_perc'] for row in actual], [row['count_perc'] for row in expected])
+
+    def test_log_tailer(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        first_log_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170630')
+        second_log_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170701')
+        with open(first_log_path, 'wb') as file:
+            file.write(b'old\n')
+        tailer = LogTailer(temp_dir)
+        self.addCleanup(tailer.close)
+        self.assertEqual(tailer.read_lines(), [])
+        with open(first_log_path, 'ab') as file:
+            file.write(b'first\nsec')
+        self.assertEqual(tailer.read_lines(), [b'first\n'])
+        with open(first_log_path, 'ab') as file:
+            file.write(b'ond')
+        with open(second_log_path, 'wb') as file:
+            file.write(b'third\n')
+        self.assertEqual(tailer.read_lines(), [b'second'])
+        self.assertEqual(tailer.read_lines(), [b'third\n'])
+
+        third_log_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170702.gz')
+        with open('./tests/fixtures/log/nginx-access-ui.log-20170630', 'rb') as file:
+            old_lines = file.read()
+        with open(third_log_path, 'wb') as file:
+            file.write(gzip.compress(old_lines))
+        tailer = LogTailer(temp_dir, read_size=10)
+        self.addCleanup(tailer.close)
+        self.assertEqual(tailer.read_lines(), [])
+        self.assertEqual(tailer.read_lines(), [])
+        with open(third_log_path, 'ab') as file:
+            file.write(gzip.compress(b'fourth\nfifth\n'))
+        self.assertEqual(tailer.read_lines(), [b'fourth\n'])
+        self.assertEqual(tailer.read_lines(), [b'fifth\n'])
+
+    def test_rolling_windows(self):
+        windows = RollingWindows([1, 5])
+        windows.add([LogRecord('/a', 1.0)], 0)
+        windows.add([LogRecord('/a', 3.0), LogRecord('/b', 2.0)], 240)
+        self.assertEqual(windows.get_report_data(1, 240)['/a'].count, 1)
+        self.assertEqual(windows.get_report_data(5, 240)['/a'].time_sum, 4.0)
+        windows.add([], 300)
+        self.assertEqual(windows.get_report_data(5, 300)['/a'].count, 1)
+        self.assertEqual(sorted(windows.buckets), [4, 5])
+
+    def test_run_stats(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        run({
+            'REPORT_SIZE': 20,
+            'REPORT_DIR': temp_dir,
+            'REPORT_TEMPLATE_PATH': './report.html',
+            'LOG_DIR': './tests/fixtures/log',
+            'ERROR_LIMIT': 10,
+            'STATS': True,
+        })
+        with open(os.path.join(temp_dir, 'report-2017.08.26.stats.json')) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['lines'], 100)
+        self.assertEqual(set(stats['stages']), {
+            'directory_scan', 'decompression', 'parsing', 'aggregation', 'report_computation', 'template_rendering'
+        })
+
+        log_dir = os.path.join(temp_dir, 'log')
+        os.mkdir(log_dir)
+        shutil.copy('./tests/fixtures/log/nginx-access-ui.log-20170826.gz', log_dir)
+        modes = [{'INCREMENTAL': True}]
+        if log_analyzer.np is not None:
+            modes.append({'COLUMNAR': True})
+        for mode in modes:
+            report_dir = os.path.join(temp_dir, 'reports-' + '-'.join(mode).lower())
+            os.mkdir(report_dir)
+            run({
+                'REPORT_SIZE': 20,
+                'REPORT_DIR': report_dir,
+                'REPORT_TEMPLATE_PATH': './report.html',
+                'LOG_DIR': log_dir,
+                'ERROR_LIMIT': 10,
+                'STATS': True,
+                **mode,
+            })
+            with open(os.path.join(report_dir, 'report-2017.08.26.stats.json')) as f:
+                self.assertEqual(json.load(f)['lines'], 100)
+
+    def test_gzip_readers(self):
+        file_path = './tests/fixtures/log/nginx-access-ui.log-20170826.gz'
+        with gzip.open(file_path, 'rb') as file:
+            expected = list(file)
+        with ThreadedGzipReader(file_path, block_size=100) as file:
+            self.assertEqual(list(file), expected)
+        with ThreadedGzipReader(file_path, block_size=100, read_ahead=1) as file:
+            self.assertEqual(file.read(10) + file.read(), b''.join(expected))
+        with ThreadedGzipReader(file_path, block_size=100) as file:
+            self.assertEqual(b''.join(iter(partial(file.read, 250), b'')), b''.join(expected))
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        members = [gzip.compress(b''.join(expected[:3])), gzip.compress(b''.join(expected[3:]))]
+        members_path = os.path.join(temp_dir, 'members.gz')
+        with open(members_path, 'wb') as file:
+            file.write(b''.join(members) + b'\x00' * 10)
+        for block_size in (len(members[0]), len(members[0]) + len(members[1])):
+            with ThreadedGzipReader(members_path, block_size=block_size) as file:
+                self.assertEqual(list(file), expected)
+        with open(members_path, 'wb') as file:
+            file.write(members[0] + members[1][:len(members[1]) // 2])
+        with self.assertRaises(EOFError):
+            with ThreadedGzipReader(members_path) as file:
+                list(file)
+        if shutil.which('gzip'):
+            with ExternalGzipReader(['gzip', '-dc'], file_path) as file:
+                self.assertEqual(list(file), expected)
+
+    def test_save_report(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        report_file_path = os.path.join(temp_dir, 'report-2017.06.30.html')
+        report_data = get_calculated_report_data(
+            aggregate_parsed_lines(parse_file('./tests/fixtures/log/nginx-access-ui.log-20170630', 10)), 20, 3
+        )
+        with open('./report.html') as f:
+            expected = Template(f.read()).safe_substitute({'table_json': json.dumps(report_data)})
+        save_report(report_data, report_file_path, './report.html')
+        with open(report_file_path) as f:
+            self.assertEqual(f.read(), expected)
+
+        save_report(report_data, report_file_path, './report.html', sidecar=True)
+        with open(os.path.join(temp_dir, 'report-2017.06.30.json')) as f:
+            self.assertEqual(json.load(f), report_data)
+        with open(report_file_path) as f:
+            self.assertIn('var table = "report-2017.06.30.json";', f.read())
+        self.assertEqual(sorted(os.listdir(temp_dir)), ['report-2017.06.30.html', 'report-2017.06.30.json'])
+
+    def test_benchmark_log_generator(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_path = os.path.join(temp_dir, 'nginx-access-ui.log-20170630.gz')
+        generate_log(file_path, 2000, 50, 1.1, 0.1)
+        result = benchmark_pipeline(LogFile(file_path, datetime.datetime(2017, 6, 30)), get_config(log_analyzer.config, {
+            'ERROR_LIMIT': 100,
+            'REPORT_TEMPLATE_PATH': './report.html',
+        }))
+        self.assertEqual(result['lines'], 2000)
+        self.assertAlmostEqual(result['errors'] / result['lines'], 0.1, delta=0.03)
+        self.assertIn('parsing', result['stages'])
+
     @staticmethod
     def remove_files_from_dir(dir):
         filelist = [file for file in os.listdir(dir) if file.endswith('.html')]
         for file in filelist:
             os.remove(os.path.join(dir, file))
+
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import asyncio
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from itertools import product
+from optparse import OptionParser, Values
+
+import memc_load
+from memc_load import (
+    get_user_apps,
+    HashRing,
+    iter_apps_batches,
+    iter_appsinstalled,
+    iter_batch_records,
+    serialize_appsinstalled,
+    serialize_batch_record,
+)
+
+DEV_TYPES = ['idfa', 'gaid', 'adid', 'dvid']
+DEVICE_MEMC = {dev_type: HashRing(['127.0.0.1:%s' % (33013 + index)]) for index, dev_type in enumerate(DEV_TYPES)}
+
+
+def generate_lines(count, seed=1, max_apps=50):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        apps = ','.join(str(rnd.randrange(10000)) for _ in range(rnd.randint(1, max_apps)))
+        yield ('%s\t%032x\t%.6f\t%.6f\t%s\n' % (
+            rnd.choice(DEV_TYPES), rnd.getrandbits(128), rnd.uniform(-90, 90), rnd.uniform(-180, 180), apps
+        )).encode('utf-8')
+
+
+def generate_files(directory, files_count, lines_count, max_apps=50):
+    paths = []
+    for index in range(files_count):
+        path = os.path.join(directory, 'benchmark-%s.tsv.gz' % index)
+        with gzip.open(path, 'wb') as file:
+            file.writelines(generate_lines(lines_count, seed=index + 1, max_apps=max_apps))
+        paths.append(path)
+    return paths
+
+
+def restore_files(paths):
+    for path in paths:
+        head, fn = os.path.split(path)
+        if os.path.exists(os.path.join(head, '.' + fn)):
+            os.rename(os.path.join(head, '.' + fn), path)
+
+
+class FakeMemcached:
+    def __init__(self, ports, latency=0.0, failure_rate=0.0, seed=1):
+        self.ports = ports
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.stored = 0
+        self.failed = 0
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.servers = []
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        for port in self.ports:
+            self.servers.append(self.loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', port)))
+        self.started.set()
+        self.loop.run_forever()
+        for server in self.servers:
+            server.close()
+        self.loop.close()
+
+    async def _handle(self, reader, writer):
+        buffer = b''
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buffer += data
+                responses = []
+                while True:
+                    end = buffer.find(b'\r\n')
+                    if end < 0:
+                        break
+                    command = buffer[:end].split()
+                    if command and command[0] == b'set':
+                        next_command = end + 2 + int(command[4]) + 2
+                        if len(buffer) < next_command:
+                            break
+                        buffer = buffer[next_command:]
+                        response = self._store()
+                        if command[-1] != b'noreply':
+                            responses.append(response)
+                    else:
+                        buffer = buffer[end + 2:]
+                        responses.append(b'END\r\n' if command and command[0] == b'get' else b'ERROR\r\n')
+                if responses:
+                    # one round trip per read, so pipelined batches pay the latency once
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    writer.write(b''.join(responses))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _store(self):
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failed += 1
+            return b'SERVER_ERROR out of memory storing object\r\n'
+        self.stored += 1
+        return b'STORED\r\n'
+
+
+def get_load_options(pattern, ports, engine, batch_size):
+    options = {
+        'test': False,
+        'log': None,
+        'dry': False,
+        'pattern': pattern,
+        'batch_size': batch_size,
+        'batch_linger': memc_load.MEMCACHE_BATCH_LINGER,
+        'queue_size': memc_load.MAX_TASK_QUEUE_SIZE,
+        'engine': engine,
+        'connections': memc_load.MEMCACHE_CONNECTIONS_PER_ADDR,
+        'chunk_mb': 0,
+        'resume': False,
+        'checkpoint_lines': memc_load.CHECKPOINT_LINES,
+        'progress_interval': 0,
+        'metrics_port': 0,
+    }
+    for dev_type, port in zip(DEV_TYPES, ports):
+        options[dev_type] = '127.0.0.1:%s' % port
+    return Values(options)
+
+
+def benchmark_load(options):
+    ports = [options.port + index for index in range(len(DEV_TYPES))]
+    server = FakeMemcached(ports, options.latency / 1000.0, options.failure_rate)
+    server.start()
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = generate_files(temp_dir, options.files, options.lines)
+        records = options.files * options.lines
+        results = {}
+        for workers, threads, batch_size, engine in product(
+            parse_ints(options.workers), parse_ints(options.threads), parse_ints(options.batch_sizes),
+            options.engines.split(',')
+        ):
+            memc_load.WORKER_COUNT = workers
+            memc_load.THREADS_PER_WORKER = threads
+            restore_files(paths)
+            stored_before = server.stored
+            started_at = time.perf_counter()
+            memc_load.main(get_load_options(os.path.join(temp_dir, '*.tsv.gz'), ports, engine, batch_size))
+            elapsed = time.perf_counter() - started_at
+            name = 'w%s t%s b%s %s' % (workers, threads, batch_size, engine)
+            results[name] = records / elapsed
+            print('%s: %s of %s records stored in %.2f sec' % (name, server.stored - stored_before, records, elapsed))
+        return results
+    finally:
+        server.stop()
+        shutil.rmtree(temp_dir)
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',')]
+
+
+def read_lines(path):
+    with gzip.open(path) as file:
+        return file.readlines()
+
+
+def parse_per_line(lines):
+    for memc_addr, appsinstalled in iter_appsinstalled(lines, DEVICE_MEMC):
+        pass
+
+
+def parse_batch(lines):
+    for batch in iter_apps_batches(lines):
+        for memc_addr, key, index in iter_batch_records(batch, DEVICE_MEMC):
+            pass
+
+
+def serialize_per_line(lines):
+    for memc_addr, appsinstalled in iter_appsinstalled(lines, DEVICE_MEMC):
+        serialize_appsinstalled(appsinstalled)
+
+
+def serialize_protobuf(lines):
+    for memc_addr, appsinstalled in iter_appsinstalled(lines, DEVICE_MEMC):
+        get_user_apps(appsinstalled)[1].SerializeToString()
+
+
+def serialize_batch(lines):
+    for batch in iter_apps_batches(lines):
+        for memc_addr, key, index in iter_batch_records(batch, DEVICE_MEMC):
+            serialize_batch_record(batch, index)
+
+
+def benchmark(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - started_at
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def print_results(results, baseline, unit='lines'):
+    for name, per_second in results.items():
+        print('%20s: %12.0f %s/sec (%.2fx)' % (name, per_second, unit, per_second / results[baseline]))
+
+
+def main(options):
+    if options.load:
+        results = benchmark_load(options)
+        print_results(results, next(iter(results)), 'records')
+        return
+    lines = read_lines(options.path) if options.path else list(generate_lines(options.lines))
+    print_results({
+        'parse per line': benchmark(parse_per_line, lines, options.repeat),
+        'parse batch': benchmark(parse_batch, lines, options.repeat),
+    }, 'parse per line')
+    print_results({
+        'serialize protobuf': benchmark(serialize_protobuf, lines, options.repeat),
+        'serialize per line': benchmark(serialize_per_line, lines, options.repeat),
+        'serialize batch': benchmark(serialize_batch, lines, options.repeat),
+    }, 'serialize protobuf')
+
+
+if __name__ == '__main__':
+    op = OptionParser()
+    op.add_option('--path', action='store', default=None)
+    op.add_option('--lines', action='store', type='int', default=100000)
+    op.add_option('--repeat', action='store', type='int', default=3)
+    op.add_option('--load', action='store_true', default=False)
+    op.add_option('--files', action='store', type='int', default=4)
+    op.add_option('--port', action='store', type='int', default=33013)
+    op.add_option('--latency', action='store', type='float', default=0.0)
+    op.add_option('--failure-rate', action='store', type='float', default=0.0)
+    op.add_option('--workers', action='store', default='1,4')
+    op.add_option('--threads', action='store', default='5')
+    op.add_option('--batch-sizes', action='store', default='100,500')
+    op.add_option('--engines', action='store', default='threads,async')
+    (opts, args) = op.parse_args()
+    main(opts)
@@ -2,39 +2,413 @@
 # -*- coding: utf-8 -*-
 import os
 import gzip
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import random
+import re
+import struct
 import sys
 import glob
 import logging
 import collections
+from array import array
 from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count, islice
 from optparse import OptionParser
 import queue
-from time import sleep
+from time import monotonic, sleep
 
 import appsinstalled_pb2
 import memcache
 import multiprocessing
+import multiprocessing.util
 import threading
 
 NORMAL_ERR_RATE = 0.01
 AppsInstalled = collections.namedtuple('AppsInstalled', ['dev_type', 'dev_id', 'lat', 'lon', 'apps'])
+AppsBatch = collections.namedtuple(
+    'AppsBatch', ['dev_types', 'dev_type_codes', 'dev_ids', 'lats', 'lons', 'apps', 'apps_offsets', 'errors']
+)
 
-MAX_TASK_QUEUE_SIZE = 0
+MAX_TASK_QUEUE_SIZE = 10000
 MAX_RESULT_QUEUE_SIZE = 0
 WORKER_COUNT = multiprocessing.cpu_count()
 THREADS_PER_WORKER = 5
 MEMCACHE_TIMEOUT = 15
+MEMCACHE_MAX_KEY_LENGTH = 250
+MAX_APP_ID = 0xFFFFFFFF
 MEMCACHE_RETRIES_COUNT = 1
 MEMCACHE_BACKOFF_FACTOR = 1
+MEMCACHE_BATCH_SIZE = 500
+MEMCACHE_BATCH_LINGER = 0.05
+MEMCACHE_CONNECTIONS_PER_ADDR = 4
+PARSE_BATCH_LINES = 10000
+CHECKPOINT_LINES = 1000000
+MEMCACHE_BREAKER_FAILURES = 5
+MEMCACHE_BREAKER_TIMEOUT = 5
+KETAMA_POINTS_PER_SERVER = 160
+VARINT_CACHE_SIZE = 1 << 14
+PROGRESS_INTERVAL = 60
+METRICS_FLUSH_INTERVAL = 1
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, float('inf'))
+STOP = None
+INVALID_KEY_CHARS = re.compile(r'[\x00-\x20\x7f]')
+
+
+class HashRing:
+    def __init__(self, nodes, points_per_server=KETAMA_POINTS_PER_SERVER):
+        self.nodes = list(nodes)
+        ring = {}
+        for node in self.nodes:
+            for index in range(points_per_server // 4):
+                digest = hashlib.md5(('%s-%s' % (node, index)).encode('utf-8')).digest()
+                for point in struct.unpack('<4I', digest):
+                    ring.setdefault(point, node)
+        self.points = sorted(ring)
+        self.point_nodes = [ring[point] for point in self.points]
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        point = struct.unpack_from('<I', hashlib.md5(key.encode('utf-8')).digest())[0]
+        index = bisect.bisect_left(self.points, point)
+        return self.point_nodes[index if index < len(self.points) else 0]
+
+
+class CircuitBreaker:
+    def __init__(self, memc_addr, failures_threshold=MEMCACHE_BREAKER_FAILURES, reset_timeout=MEMCACHE_BREAKER_TIMEOUT):
+        self.memc_addr = memc_addr
+        self.failures_threshold = failures_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0
+        self.is_probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.failures < self.failures_threshold:
+                return True
+            if self.is_probing or monotonic() < self.open_until:
+                return False
+            self.is_probing = True
+            return True
+
+    def record(self, is_success):
+        with self.lock:
+            self.is_probing = False
+            if is_success:
+                if self.failures >= self.failures_threshold:
+                    logging.info('Circuit breaker for %s is closed' % self.memc_addr)
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.failures_threshold:
+                self.open_until = monotonic() + self.reset_timeout
+                logging.error('Circuit breaker for %s is open for %ss' % (self.memc_addr, self.reset_timeout))
+
+
+class RetryScheduler:
+    def __init__(self):
+        self.heap = []
+        self.counter = count()
+        self.lock = threading.Lock()
+
+    def schedule(self, due_at, memc_addr, batch, attempt):
+        with self.lock:
+            heapq.heappush(self.heap, (due_at, next(self.counter), memc_addr, batch, attempt))
+
+    def pop_due(self, now):
+        with self.lock:
+            if self.heap and self.heap[0][0] <= now:
+                return heapq.heappop(self.heap)[2:]
+        return None
+
+    def next_due(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+
+def get_retry_delay(attempt, breaker):
+    return max(MEMCACHE_BACKOFF_FACTOR * (2 ** attempt), breaker.open_until - monotonic())
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> [lines, bytes read, compressed bytes read, compressed size]
+        self.files = {}
+        # memc_addr -> [records, errors, retries, batches, latency sum, latency bucket counts]
+        self.nodes = {}
+        # pid -> {queue name: depth}
+        self.queues = {}
+        self.queue_sizes = {}
+
+    def add_file_progress(self, path, lines, file):
+        stats = [lines, file.tell(), file.fileobj.tell(), os.path.getsize(path)]
+        with self.lock:
+            self.merge_file_stats(path, stats)
+
+    def add_node_counts(self, memc_addr, processed, errors, retries=0):
+        with self.lock:
+            self.merge_node_stats(memc_addr, [processed, errors, retries, 0, 0.0, None])
+
+    def observe_latency(self, memc_addr, latency):
+        buckets = [0] * len(LATENCY_BUCKETS)
+        buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] = 1
+        with self.lock:
+            self.merge_node_stats(memc_addr, [0, 0, 0, 1, latency, buckets])
+
+    def track_queue(self, name, size):
+        self.queue_sizes[name] = size
+
+    def untrack_queue(self, name):
+        self.queue_sizes.pop(name, None)
+
+    def merge_file_stats(self, path, other):
+        stats = self.files.setdefault(path, [0, 0, 0, 0])
+        stats[0] += other[0]
+        # positions are absolute, so the furthest report wins
+        stats[1:] = [max(value, other_value) for value, other_value in zip(stats[1:], other[1:])]
+
+    def merge_node_stats(self, memc_addr, other):
+        stats = self.nodes.setdefault(memc_addr, [0, 0, 0, 0, 0.0, [0] * len(LATENCY_BUCKETS)])
+        for index in range(5):
+            stats[index] += other[index]
+        if other[5]:
+            stats[5] = [count + other_count for count, other_count in zip(stats[5], other[5])]
+
+    def flush(self):
+        queues = {name: size() for name, size in list(self.queue_sizes.items())}
+        with self.lock:
+            files, nodes = self.files, self.nodes
+            self.files, self.nodes = {}, {}
+        return {'files': files, 'nodes': nodes, 'queues': queues}
+
+    def merge(self, pid, delta):
+        with self.lock:
+            for path, stats in delta['files'].items():
+                self.merge_file_stats(path, stats)
+            for memc_addr, stats in delta['nodes'].items():
+                self.merge_node_stats(memc_addr, stats)
+            self.queues[pid] = delta['queues']
+
+    def get_queue_depths(self):
+        depths = collections.Counter()
+        for queues in self.queues.values():
+            depths.update(queues)
+        return depths
+
+    def render_prometheus(self):
+        with self.lock:
+            lines = []
+            for name, metric_type, help_text, values in [
+                ('memc_load_file_lines', 'counter', 'Lines read from a file', [
+                    ({'file': path}, stats[0]) for path, stats in self.files.items()
+                ]),
+                ('memc_load_file_read_bytes', 'gauge', 'Decompressed bytes read from a file', [
+                    ({'file': path}, stats[1]) for path, stats in self.files.items()
+                ]),
+                ('memc_load_file_compressed_read_bytes', 'gauge', 'Compressed bytes read from a file', [
+                    ({'file': path}, stats[2]) for path, stats in self.files.items()
+                ]),
+                ('memc_load_file_compressed_bytes', 'gauge', 'Compressed size of a file', [
+                    ({'file': path}, stats[3]) for path, stats in self.files.items()
+                ]),
+                ('memc_load_records', 'counter', 'Records stored in memcached', [
+                    ({'memc_addr': memc_addr}, stats[0]) for memc_addr, stats in self.nodes.items()
+                ]),
+                ('memc_load_errors', 'counter', 'Records that could not be stored', [
+                    ({'memc_addr': memc_addr}, stats[1]) for memc_addr, stats in self.nodes.items()
+                ]),
+                ('memc_load_retries', 'counter', 'Batches scheduled for a retry', [
+                    ({'memc_addr': memc_addr}, stats[2]) for memc_addr, stats in self.nodes.items()
+                ]),
+                ('memc_load_queue_depth', 'gauge', 'Items waiting in a queue, summed over workers', [
+                    ({'queue': name}, depth) for name, depth in sorted(self.get_queue_depths().items())
+                ]),
+            ]:
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in values:
+                    lines.append('%s%s %s' % (get_metric_name(name, metric_type), format_labels(labels), value))
+            name = 'memc_load_batch_latency_seconds'
+            lines.append('# HELP %s Latency of a batch write to memcached' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for memc_addr, (_, _, _, batches, latency_sum, buckets) in self.nodes.items():
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket_count
+                    labels = {'memc_addr': memc_addr, 'le': '+Inf' if bound == float('inf') else repr(bound)}
+                    lines.append('%s_bucket%s %s' % (name, format_labels(labels), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels({'memc_addr': memc_addr}), latency_sum))
+                lines.append('%s_count%s %s' % (name, format_labels({'memc_addr': memc_addr}), batches))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def get_metric_name(name, metric_type):
+    return name + '_total' if metric_type == 'counter' else name
+
+
+def format_labels(labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+
+
+def get_bucket_percentile(buckets, percentile):
+    total = sum(buckets)
+    if not total:
+        return 0
+    cumulative = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= total * percentile / 100.0:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+
+def run_metrics_flusher(metrics_queue, interval=METRICS_FLUSH_INTERVAL):
+    # a forked worker starts with a copy of the parent's metrics
+    METRICS.flush()
+
+    def flush():
+        metrics_queue.put((os.getpid(), METRICS.flush()))
+
+    def run():
+        while True:
+            sleep(interval)
+            flush()
+
+    threading.Thread(target=run, daemon=True).start()
+    # must run before the queue's own finalizer (exitpriority 10) closes its feeder thread
+    multiprocessing.util.Finalize(None, flush, exitpriority=20)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metrics request: %s' % (format % args))
+
+
+class ProgressReporter:
+    def __init__(self, metrics_queue, interval=PROGRESS_INTERVAL, port=0):
+        self.metrics_queue = metrics_queue
+        self.interval = interval
+        self.metrics = Metrics()
+        self.server = None
+        if port:
+            self.server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+            self.server.metrics = self.metrics
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.started_at = self.reported_at = monotonic()
+        self.reported_files = {}
+        self.reported_nodes = {}
+
+    def start(self):
+        self.thread.start()
+        if self.server:
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logging.info('Serving metrics on http://127.0.0.1:%s/metrics' % self.server.server_port)
+
+    def _run(self):
+        next_report_at = monotonic() + self.interval
+        while not self.stopped.is_set():
+            self._collect(METRICS_FLUSH_INTERVAL)
+            if self.interval and monotonic() >= next_report_at:
+                self.log_progress()
+                next_report_at = monotonic() + self.interval
+
+    def _collect(self, timeout):
+        try:
+            self.metrics.merge(*self.metrics_queue.get(timeout=timeout))
+            while True:
+                self.metrics.merge(*self.metrics_queue.get_nowait())
+        except queue.Empty:
+            pass
+        self.metrics.merge(os.getpid(), METRICS.flush())
+
+    def log_progress(self):
+        now = monotonic()
+        elapsed = now - self.reported_at
+        with self.metrics.lock:
+            files = {path: list(stats) for path, stats in self.metrics.files.items()}
+            nodes = {memc_addr: list(stats) for memc_addr, stats in self.metrics.nodes.items()}
+            queue_depths = self.metrics.get_queue_depths()
+        for path, (lines, read, compressed_read, compressed_size) in sorted(files.items()):
+            if self.reported_files.get(path) == lines:
+                continue
+            logging.info('File %s: %.1f%% of %.1f MB read, %.1f MB decompressed, %s lines' % (
+                path, 100.0 * compressed_read / compressed_size if compressed_size else 100.0,
+                compressed_size / 1048576.0, read / 1048576.0, lines
+            ))
+        for memc_addr, (processed, errors, retries, batches, _, buckets) in sorted(nodes.items()):
+            reported = self.reported_nodes.get(memc_addr, [0, 0, 0, 0, 0.0, [0] * len(LATENCY_BUCKETS)])
+            recent_buckets = [count - reported_count for count, reported_count in zip(buckets, reported[5])]
+            logging.info('Node %s: %.0f records/sec, %s errors, %s retries, p50 %.1f ms, p99 %.1f ms' % (
+                memc_addr, (processed - reported[0]) / elapsed if elapsed else 0, errors, retries,
+                1000 * get_bucket_percentile(recent_buckets, 50), 1000 * get_bucket_percentile(recent_buckets, 99)
+            ))
+        processed = sum(stats[0] for stats in nodes.values())
+        reported_processed = sum(stats[0] for stats in self.reported_nodes.values())
+        logging.info('Progress: %s records, %.0f records/sec, %s errors, %s retries, queues: %s' % (
+            processed, (processed - reported_processed) / elapsed if elapsed else 0,
+            sum(stats[1] for stats in nodes.values()), sum(stats[2] for stats in nodes.values()),
+            ', '.join('%s=%s' % item for item in sorted(queue_depths.items())) or 'empty'
+        ))
+        self.reported_at = now
+        self.reported_files = {path: stats[0] for path, stats in files.items()}
+        self.reported_nodes = nodes
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._collect(0)
+        if self.interval:
+            # the last report covers the whole run
+            self.reported_at = self.started_at
+            self.reported_files = {}
+            self.reported_nodes = {}
+            self.log_progress()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
 
 
 class AppsInsertPool:
-    def __init__(self, threads_count, task_queue, result_queue):
+    def __init__(self, threads_count, task_queue, result_queue, batch_size=MEMCACHE_BATCH_SIZE,
+                 batch_linger=MEMCACHE_BATCH_LINGER):
         self.threads_count = threads_count
         self.threads = []
         self.tasks_queue = task_queue
         self.result_queue = result_queue
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger
         self.memc_pool = collections.defaultdict(queue.Queue)
+        self.breakers = {}
+        self.retries = RetryScheduler()
 
     def run_threads(self):
         for _ in range(self.threads_count):
@@ -43,23 +417,99 @@ class AppsInsertPool:
             thread.start()
 
     def _run(self):
+        processed = errors = 0
+        batches = {}
+        node_stats = {}
+        try:
+            while True:
+                deadlines = [created_at + self.batch_linger for created_at, _ in batches.values()]
+                next_retry_at = self.retries.next_due()
+                if next_retry_at is not None:
+                    deadlines.append(next_retry_at)
+                timeout = max(0, min(deadlines) - monotonic()) if deadlines else None
+                try:
+                    task = self.tasks_queue.get(timeout=timeout)
+                except queue.Empty:
+                    task = ()
+                if task is STOP:
+                    break
+                if task:
+                    memc_addr, appsinstalled, dry_run = task
+                    try:
+                        if dry_run:
+                            log_appsinstalled(memc_addr, appsinstalled)
+                            processed += 1
+                            continue
+                        key, packed = serialize_appsinstalled(appsinstalled)
+                    except Exception as e:
+                        logging.exception('Cannot serialize %s: %s' % (appsinstalled.dev_id, e))
+                        errors += 1
+                        continue
+                    batches.setdefault(memc_addr, (monotonic(), {}))[1][key] = packed
+                batch_processed, batch_errors = self._flush_batches(batches, node_stats)
+                processed += batch_processed
+                errors += batch_errors
+                batch_processed, batch_errors = self._send_due_retries(node_stats)
+                processed += batch_processed
+                errors += batch_errors
+            batch_processed, batch_errors = self._flush_batches(batches, node_stats, force=True)
+            processed += batch_processed
+            errors += batch_errors
+            while True:
+                next_retry_at = self.retries.next_due()
+                if next_retry_at is None:
+                    break
+                sleep(max(0, next_retry_at - monotonic()))
+                batch_processed, batch_errors = self._send_due_retries(node_stats)
+                processed += batch_processed
+                errors += batch_errors
+        finally:
+            self.result_queue.put((processed, errors, node_stats))
+
+    def _flush_batches(self, batches, node_stats, force=False):
+        processed = errors = 0
+        now = monotonic()
+        for memc_addr, (created_at, batch) in list(batches.items()):
+            if force or len(batch) >= self.batch_size or now - created_at >= self.batch_linger:
+                del batches[memc_addr]
+                batch_processed, batch_errors = self._insert_batch(memc_addr, batch, 0, node_stats)
+                processed += batch_processed
+                errors += batch_errors
+        return processed, errors
+
+    def _send_due_retries(self, node_stats):
         processed = errors = 0
         while True:
+            retry = self.retries.pop_due(monotonic())
+            if retry is None:
+                return processed, errors
+            batch_processed, batch_errors = self._insert_batch(*retry, node_stats=node_stats)
+            processed += batch_processed
+            errors += batch_errors
+
+    def _insert_batch(self, memc_addr, batch, attempt, node_stats):
+        breaker = self.breakers.setdefault(memc_addr, CircuitBreaker(memc_addr))
+        started_at = monotonic()
+        if breaker.allow():
+            memc_client = self._get_memc_client(memc_addr)
             try:
-                memc_addr, appsinstalled, dry_run = self.tasks_queue.get(timeout=1)
-                memc_client = self._get_memc_client(memc_addr)
-                is_success = insert_appsinstalled(memc_client, memc_addr, appsinstalled, dry_run)
+                failed = insert_appsinstalled_batch(memc_client, memc_addr, batch)
+            finally:
                 self.memc_pool[memc_addr].put(memc_client)
-                if is_success:
-                    processed += 1
-                else:
-                    errors += 1
-            except queue.Empty:
-                try:
-                    self.result_queue.put((processed, errors), timeout=0.1)
-                except queue.Full:
-                    logging.error('Result queue is overflew')
-                return
+            METRICS.observe_latency(memc_addr, monotonic() - started_at)
+            breaker.record(len(failed) < len(batch))
+        else:
+            failed = batch
+        batch_processed = len(batch) - len(failed)
+        batch_errors = retries = 0
+        if failed and attempt < MEMCACHE_RETRIES_COUNT:
+            self.retries.schedule(monotonic() + get_retry_delay(attempt, breaker), memc_addr, failed, attempt + 1)
+            retries = 1
+        else:
+            batch_errors = len(failed)
+        METRICS.add_node_counts(memc_addr, batch_processed, batch_errors, retries)
+        add_node_stats(node_stats, memc_addr, batch_processed, batch_errors, monotonic() - started_at)
+        return batch_processed, batch_errors
 
     def _get_memc_client(self, memc_addr):
         try:
@@ -67,6 +517,10 @@ class AppsInsertPool:
         except queue.Empty:
             return memcache.Client([memc_addr], socket_timeout=MEMCACHE_TIMEOUT)
 
+    def stop(self):
+        for _ in self.threads:
+            self.tasks_queue.put(STOP)
+
     def wait(self):
         for thread in self.threads:
             thread.join()
@@ -77,29 +531,148 @@ class AppsParser:
         self.tasks_queue = task_queue
         self.result_queue = result_queue
 
-    def run(self, path, device_memc, dry):
+    def run(self, lines, device_memc, dry):
         processed = errors = 0
-        logging.info('Processing %s' % path)
-        with gzip.open(path) as file:
-            for line in file:
-                line = line.strip()
-                if not line:
-                    continue
-                appsinstalled = parse_appsinstalled(line)
-                if not appsinstalled:
-                    errors += 1
-                    continue
-                memc_addr = device_memc.get(appsinstalled.dev_type)
+        for memc_addr, appsinstalled in iter_appsinstalled(lines, device_memc):
+            if not memc_addr:
+                errors += 1
+                continue
+            self.tasks_queue.put((memc_addr, appsinstalled, dry))
+        self.result_queue.put((processed, errors, {}))
+
+
+class AsyncMemcacheConnections:
+    def __init__(self, memc_addr, connections_count=MEMCACHE_CONNECTIONS_PER_ADDR):
+        self.memc_addr = memc_addr
+        self.host, self.port = memc_addr.rsplit(':', 1)
+        self.connections = asyncio.Queue()
+        for _ in range(connections_count):
+            self.connections.put_nowait(None)
+
+    async def set_multi(self, batch):
+        connection = await self.connections.get()
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, int(self.port)), MEMCACHE_TIMEOUT
+                )
+            reader, writer = connection
+            writer.write(b''.join(
+                b'set %s 0 0 %d\r\n%s\r\n' % (key.encode('utf-8'), len(packed), packed)
+                for key, packed in batch.items()
+            ))
+            await asyncio.wait_for(writer.drain(), MEMCACHE_TIMEOUT)
+            failed_keys = []
+            for key in batch:
+                response = await asyncio.wait_for(reader.readline(), MEMCACHE_TIMEOUT)
+                if not response:
+                    raise ConnectionError('Connection closed by server')
+                if response != b'STORED\r\n':
+                    failed_keys.append(key)
+            return failed_keys
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.error('Cannot write to memc %s: %s' % (self.memc_addr, e))
+            if connection is not None:
+                connection[1].close()
+                connection = None
+            return list(batch)
+        finally:
+            self.connections.put_nowait(connection)
+
+    async def close(self):
+        while not self.connections.empty():
+            connection = self.connections.get_nowait()
+            if connection is not None:
+                connection[1].close()
+
+
+class AsyncAppsInserter:
+    def __init__(self, connections_count=MEMCACHE_CONNECTIONS_PER_ADDR):
+        self.connections_count = connections_count
+        self.memc_pool = {}
+        self.breakers = {}
+        self.limits = {}
+        self.tasks = set()
+        self.processed = 0
+        self.errors = 0
+        self.node_stats = {}
+
+    async def insert(self, memc_addr, batch):
+        if memc_addr not in self.memc_pool:
+            self.memc_pool[memc_addr] = AsyncMemcacheConnections(memc_addr, self.connections_count)
+            self.limits[memc_addr] = asyncio.Semaphore(self.connections_count * 2)
+        limit = self.limits[memc_addr]
+        await limit.acquire()
+        task = asyncio.ensure_future(self._insert_batch(memc_addr, batch, limit))
+        task.add_done_callback(self.tasks.discard)
+        self.tasks.add(task)
+        await asyncio.sleep(0)
+
+    async def _insert_batch(self, memc_addr, batch, limit):
+        started_at = monotonic()
+        breaker = self.breakers.setdefault(memc_addr, CircuitBreaker(memc_addr))
+        pending = batch
+        is_limited = True
+        try:
+            for attempt in range(MEMCACHE_RETRIES_COUNT + 1):
+                if breaker.allow():
+                    sent_at = monotonic()
+                    failed_keys = await self.memc_pool[memc_addr].set_multi(pending)
+                    METRICS.observe_latency(memc_addr, monotonic() - sent_at)
+                    breaker.record(len(failed_keys) < len(pending))
+                    pending = {key: pending[key] for key in failed_keys}
+                if not pending:
+                    break
+                if is_limited:
+                    # a batch waiting for a retry must not hold back fresh batches to the same node
+                    limit.release()
+                    is_limited = False
+                if attempt < MEMCACHE_RETRIES_COUNT:
+                    METRICS.add_node_counts(memc_addr, 0, 0, 1)
+                    await asyncio.sleep(get_retry_delay(attempt, breaker))
+        finally:
+            if is_limited:
+                limit.release()
+        self.processed += len(batch) - len(pending)
+        self.errors += len(pending)
+        METRICS.add_node_counts(memc_addr, len(batch) - len(pending), len(pending))
+        add_node_stats(self.node_stats, memc_addr, len(batch) - len(pending), len(pending), monotonic() - started_at)
+
+    async def wait(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        for connections in self.memc_pool.values():
+            await connections.close()
+
+
+async def load_lines_async(lines, device_memc, dry, batch_size=MEMCACHE_BATCH_SIZE,
+                           connections_count=MEMCACHE_CONNECTIONS_PER_ADDR):
+    inserter = AsyncAppsInserter(connections_count)
+    processed = errors = 0
+    batches = collections.defaultdict(dict)
+    METRICS.track_queue('batches', inserter.tasks.__len__)
+    try:
+        for apps_batch in iter_apps_batches(lines):
+            errors += apps_batch.errors
+            for memc_addr, key, index in iter_batch_records(apps_batch, device_memc):
                 if not memc_addr:
                     errors += 1
-                    logging.error('Unknown device type: %s' % appsinstalled.dev_type)
                     continue
-                self.tasks_queue.put((memc_addr, appsinstalled, dry))
-        try:
-            self.result_queue.put((processed, errors), timeout=0.1)
-        except queue.Full:
-            logging.error('Result queue is overflew')
-        return
+                packed = serialize_batch_record(apps_batch, index)
+                if dry:
+                    logging.debug('%s - %s -> %r' % (memc_addr, key, packed))
+                    processed += 1
+                    continue
+                batch = batches[memc_addr]
+                batch[key] = packed
+                if len(batch) >= batch_size:
+                    await inserter.insert(memc_addr, batches.pop(memc_addr))
+        for memc_addr, batch in batches.items():
+            await inserter.insert(memc_addr, batch)
+    finally:
+        await inserter.wait()
+        METRICS.untrack_queue('batches')
+    return processed + inserter.processed, errors + inserter.errors, inserter.node_stats
 
 
 def dot_rename(path):
@@ -108,54 +681,200 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, '.' + fn))
 
 
-def insert_appsinstalled(memc_client, memc_addr, appsinstalled, dry_run=False):
+def get_user_apps(appsinstalled):
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
     ua.lon = appsinstalled.lon
-    key = '%s:%s' % (appsinstalled.dev_type, appsinstalled.dev_id)
     ua.apps.extend(appsinstalled.apps)
-    packed = ua.SerializeToString()
+    return '%s:%s' % (appsinstalled.dev_type, appsinstalled.dev_id), ua
+
+
+def encode_varint(value):
+    if not 0 <= value <= MAX_APP_ID:
+        raise ValueError('Value out of range: %d' % value)
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+# field 1 (apps) is an unpacked proto2 repeated uint32: a 0x08 tag before every varint
+APPS_FIELD_CACHE = {value: b'\x08' + encode_varint(value) for value in range(VARINT_CACHE_SIZE)}
+LAT_LON_FIELDS = struct.Struct('<BdBd')
+
+
+def encode_app(app):
+    return APPS_FIELD_CACHE.get(app) or b'\x08' + encode_varint(app)
+
+
+def encode_user_apps(apps, lat, lon):
     try:
-        if not dry_run:
-            is_success = False
-            for attempt in range(MEMCACHE_RETRIES_COUNT + 1):
-                is_success = memc_client.set(key, packed)
-                if is_success:
-                    break
-                sleep(MEMCACHE_BACKOFF_FACTOR * (2 ** attempt))
-            return is_success
-        logging.debug('%s - %s -> %s' % (memc_addr, key, str(ua).replace('\n', ' ')))
+        encoded_apps = b''.join([APPS_FIELD_CACHE[app] for app in apps])
+    except KeyError:
+        encoded_apps = b''.join([encode_app(app) for app in apps])
+    return encoded_apps + LAT_LON_FIELDS.pack(0x11, lat, 0x19, lon)
+
+
+def serialize_appsinstalled(appsinstalled):
+    key = '%s:%s' % (appsinstalled.dev_type, appsinstalled.dev_id)
+    return key, encode_user_apps(appsinstalled.apps, appsinstalled.lat, appsinstalled.lon)
+
+
+def log_appsinstalled(memc_addr, appsinstalled):
+    key, ua = get_user_apps(appsinstalled)
+    logging.debug('%s - %s -> %s' % (memc_addr, key, str(ua).replace('\n', ' ')))
+
+
+def insert_appsinstalled_batch(memc_client, memc_addr, batch):
+    try:
+        failed_keys = memc_client.set_multi(batch)
     except Exception as e:
         logging.exception('Cannot write to memc %s: %s' % (memc_addr, e))
-        return False
-    return True
+        failed_keys = list(batch)
+    return {key: batch[key] for key in failed_keys}
+
+
+def iter_appsinstalled(lines, device_memc):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        appsinstalled = parse_appsinstalled(line)
+        if not appsinstalled:
+            yield None, None
+            continue
+        memc_ring = device_memc.get(appsinstalled.dev_type)
+        if not memc_ring:
+            logging.error('Unknown device type: %s' % appsinstalled.dev_type)
+            yield None, None
+            continue
+        key = '%s:%s' % (appsinstalled.dev_type, appsinstalled.dev_id)
+        if not is_valid_key(key):
+            logging.error('Invalid memcache key: %r' % key)
+            yield None, None
+            continue
+        yield memc_ring.get_node(key), appsinstalled
+
 
+def is_valid_key(key):
+    return len(key.encode('utf-8')) <= MEMCACHE_MAX_KEY_LENGTH and not INVALID_KEY_CHARS.search(key)
 
+
+# both parsers take the same records: five tab-separated fields of a stripped line, non-empty
+# utf-8 dev_type and dev_id, float coords; apps that are not integers in 0..MAX_APP_ID are dropped
 def parse_appsinstalled(line):
-    line_parts = line.decode('utf-8').strip().split('\t')
-    if len(line_parts) < 5:
+    line_parts = line.strip().split(b'\t')
+    if len(line_parts) != 5:
         return
     dev_type, dev_id, lat, lon, raw_apps = line_parts
     if not dev_type or not dev_id:
         return
     try:
-        apps = [int(a.strip()) for a in raw_apps.split(',')]
+        dev_type, dev_id = dev_type.decode('utf-8'), dev_id.decode('utf-8')
+        lat, lon = float(lat), float(lon)
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(',') if a.isidigit()]
-        logging.info('Not all user apps are digits: `%s`' % line)
+        logging.info('Invalid record: `%s`' % line)
+        return
+    raw_apps = raw_apps.split(b',')
     try:
-        lat, lon = float(lat), float(lon)
+        apps = [int(a) for a in raw_apps]
+        is_valid = 0 <= min(apps) and max(apps) <= MAX_APP_ID
     except ValueError:
-        logging.info('Invalid geo coords: `%s`' % line)
+        is_valid = False
+    if not is_valid:
+        apps = parse_apps(raw_apps)
+        logging.info('Not all user apps are digits: `%s`' % line)
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
-def log_result(result_queue):
-    processed = errors = 0
-    while not result_queue.empty():
-        processed_per_worker, errors_per_worker = result_queue.get()
-        processed += processed_per_worker
-        errors += errors_per_worker
+def parse_apps(raw_apps):
+    apps = []
+    for app in raw_apps:
+        try:
+            app = int(app)
+        except ValueError:
+            continue
+        if 0 <= app <= MAX_APP_ID:
+            apps.append(app)
+    return apps
+
+
+def parse_appsinstalled_batch(lines):
+    dev_type_codes = {}
+    codes = array('H')
+    dev_ids = []
+    lats = array('d')
+    lons = array('d')
+    apps = array('I')
+    apps_offsets = array('L', [0])
+    errors = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        line_parts = line.split(b'\t')
+        if len(line_parts) != 5 or not line_parts[0] or not line_parts[1]:
+            errors += 1
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = line_parts
+        try:
+            dev_type.decode('utf-8')
+            dev_id = dev_id.decode('utf-8')
+            lat, lon = float(lat), float(lon)
+        except ValueError:
+            logging.info('Invalid record: `%s`' % line)
+            errors += 1
+            continue
+        raw_apps = raw_apps.split(b',')
+        try:
+            apps.extend(map(int, raw_apps))
+        except (ValueError, OverflowError):
+            del apps[apps_offsets[-1]:]
+            logging.info('Not all user apps are digits: `%s`' % line)
+            apps.extend(parse_apps(raw_apps))
+        codes.append(dev_type_codes.setdefault(dev_type, len(dev_type_codes)))
+        dev_ids.append(dev_id)
+        lats.append(lat)
+        lons.append(lon)
+        apps_offsets.append(len(apps))
+    dev_types = [dev_type.decode('utf-8') for dev_type in dev_type_codes]
+    return AppsBatch(dev_types, codes, dev_ids, lats, lons, apps, apps_offsets, errors)
+
+
+def iter_apps_batches(lines, batch_lines=PARSE_BATCH_LINES):
+    lines = iter(lines)
+    while True:
+        batch_lines_chunk = list(islice(lines, batch_lines))
+        if not batch_lines_chunk:
+            return
+        yield parse_appsinstalled_batch(batch_lines_chunk)
+
+
+def iter_batch_records(batch, device_memc):
+    memc_rings = [device_memc.get(dev_type) for dev_type in batch.dev_types]
+    for index, code in enumerate(batch.dev_type_codes):
+        memc_ring = memc_rings[code]
+        if not memc_ring:
+            logging.error('Unknown device type: %s' % batch.dev_types[code])
+            yield None, None, index
+            continue
+        key = '%s:%s' % (batch.dev_types[code], batch.dev_ids[index])
+        if not is_valid_key(key):
+            logging.error('Invalid memcache key: %r' % key)
+            yield None, None, index
+            continue
+        yield memc_ring.get_node(key), key, index
+
+
+def serialize_batch_record(batch, index):
+    return encode_user_apps(
+        batch.apps[batch.apps_offsets[index]:batch.apps_offsets[index + 1]], batch.lats[index], batch.lons[index]
+    )
+
+
+def log_error_rate(processed, errors):
     if not processed:
         logging.info('There are no processed files. Did you forget to start a memcache server?')
         return
@@ -166,23 +885,198 @@ def log_result(result_queue):
         logging.error('High error rate (%s > %s). Failed load' % (err_rate, NORMAL_ERR_RATE))
 
 
-def process_file(path, device_memc, dry):
-    task_queue = queue.Queue(maxsize=MAX_TASK_QUEUE_SIZE)
+def add_node_stats(node_stats, memc_addr, processed, errors, elapsed, batches=1):
+    stats = node_stats.setdefault(memc_addr, [0, 0, 0, 0.0])
+    stats[0] += processed
+    stats[1] += errors
+    stats[2] += batches
+    stats[3] += elapsed
+
+
+def merge_node_stats(node_stats, other):
+    for memc_addr, (processed, errors, batches, elapsed) in other.items():
+        add_node_stats(node_stats, memc_addr, processed, errors, elapsed, batches)
+    return node_stats
+
+
+def log_node_stats(node_stats, elapsed):
+    for memc_addr, (processed, errors, batches, busy_time) in sorted(node_stats.items()):
+        logging.info('Node %s: %s records, %s errors, %.0f records/sec, %.1f ms per batch' % (
+            memc_addr, processed, errors, processed / elapsed if elapsed else 0,
+            1000 * busy_time / batches if batches else 0
+        ))
+
+
+def collect_results(result_queue, results_count):
+    processed = errors = 0
+    node_stats = {}
+    for _ in range(results_count):
+        processed_per_worker, errors_per_worker, node_stats_per_worker = result_queue.get()
+        processed += processed_per_worker
+        errors += errors_per_worker
+        merge_node_stats(node_stats, node_stats_per_worker)
+    return processed, errors, node_stats
+
+
+def process_lines(lines, device_memc, dry, batch_size=MEMCACHE_BATCH_SIZE, batch_linger=MEMCACHE_BATCH_LINGER,
+                  queue_size=MAX_TASK_QUEUE_SIZE, engine='threads', connections_count=MEMCACHE_CONNECTIONS_PER_ADDR):
+    if engine == 'async':
+        # asyncio.run needs python3.7
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(load_lines_async(lines, device_memc, dry, batch_size, connections_count))
+        finally:
+            loop.close()
+
+    task_queue = queue.Queue(maxsize=queue_size)
     result_queue = queue.Queue(maxsize=MAX_RESULT_QUEUE_SIZE)
 
-    pool = AppsInsertPool(THREADS_PER_WORKER, task_queue, result_queue)
+    pool = AppsInsertPool(THREADS_PER_WORKER, task_queue, result_queue, batch_size, batch_linger)
     pool.run_threads()
+    METRICS.track_queue('tasks', task_queue.qsize)
+    METRICS.track_queue('retries', pool.retries.__len__)
 
     parser = AppsParser(task_queue, result_queue)
-    parser.run(path, device_memc, dry)
+    try:
+        parser.run(lines, device_memc, dry)
+    finally:
+        pool.stop()
+        pool.wait()
+        METRICS.untrack_queue('tasks')
+        METRICS.untrack_queue('retries')
+
+    return collect_results(result_queue, pool.threads_count + 1)
+
+
+def get_checkpoint_path(path):
+    return '%s.checkpoint' % path
+
 
-    pool.wait()
+def load_checkpoint(path):
+    try:
+        with open(get_checkpoint_path(path)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(path)
+    if checkpoint.get('size') != stat.st_size or checkpoint.get('mtime') != stat.st_mtime:
+        logging.info('Checkpoint of %s is stale, starting from the beginning' % path)
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, offset, processed, errors):
+    stat = os.stat(path)
+    checkpoint_path = get_checkpoint_path(path)
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump({
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'offset': offset,
+            'processed': processed,
+            'errors': errors,
+        }, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(get_checkpoint_path(path))
+    except FileNotFoundError:
+        pass
 
-    log_result(result_queue)
 
+def get_start_state(path, resume):
+    checkpoint = load_checkpoint(path) if resume else None
+    if not checkpoint:
+        return 0, 0, 0
+    logging.info('Resuming %s from offset %s' % (path, checkpoint['offset']))
+    return checkpoint['offset'], checkpoint['processed'], checkpoint['errors']
+
+
+def process_file(path, device_memc, dry, resume=False, checkpoint_lines=CHECKPOINT_LINES, **kwargs):
+    logging.info('Processing %s' % path)
+    started_at = monotonic()
+    offset, processed, errors = get_start_state(path, resume)
+    node_stats = {}
+    with gzip.open(path) as file:
+        file.seek(offset)
+        while True:
+            segment = iter_file_progress(path, file, islice(file, checkpoint_lines))
+            segment_processed, segment_errors, segment_node_stats = process_lines(
+                segment, device_memc, dry, **kwargs
+            )
+            if file.tell() == offset:
+                break
+            offset = file.tell()
+            processed += segment_processed
+            errors += segment_errors
+            merge_node_stats(node_stats, segment_node_stats)
+            save_checkpoint(path, offset, processed, errors)
+    log_node_stats(node_stats, monotonic() - started_at)
+    log_error_rate(processed, errors)
     return path
 
 
+def iter_file_progress(path, file, lines, every=PARSE_BATCH_LINES):
+    index = 0
+    for index, line in enumerate(lines, 1):
+        yield line
+        if not index % every:
+            METRICS.add_file_progress(path, every, file)
+    METRICS.add_file_progress(path, index % every, file)
+
+
+def process_chunk(chunk, device_memc, dry, **kwargs):
+    path, block = chunk
+    return process_lines(block.splitlines(), device_memc, dry, **kwargs)
+
+
+def iter_file_chunks(path, chunk_size, offset=0):
+    with gzip.open(path) as file:
+        file.seek(offset)
+        while True:
+            block = file.read(chunk_size)
+            if not block:
+                break
+            block += file.readline()
+            METRICS.add_file_progress(path, block.count(b'\n'), file)
+            yield block, file.tell()
+
+
+def process_files_chunked(pool, path_list, process, chunk_size, window, resume=False):
+    pending = collections.deque()
+    results = {}
+    METRICS.track_queue('chunks', pending.__len__)
+    for path in path_list:
+        logging.info('Processing %s' % path)
+        offset, processed, errors = get_start_state(path, resume)
+        results[path] = [processed, errors, {}, monotonic()]
+        for block, offset in iter_file_chunks(path, chunk_size, offset):
+            pending.append((path, pool.apply_async(process, ((path, block),)), offset))
+            while len(pending) > window:
+                yield from collect_chunk_result(pending, results)
+        pending.append((path, None, offset))
+    while pending:
+        yield from collect_chunk_result(pending, results)
+    METRICS.untrack_queue('chunks')
+
+
+def collect_chunk_result(pending, results):
+    path, async_result, offset = pending.popleft()
+    if async_result is None:
+        processed, errors, node_stats, started_at = results.pop(path)
+        log_node_stats(node_stats, monotonic() - started_at)
+        log_error_rate(processed, errors)
+        yield path
+        return
+    processed, errors, node_stats = async_result.get()
+    results[path][0] += processed
+    results[path][1] += errors
+    merge_node_stats(results[path][2], node_stats)
+    save_checkpoint(path, offset, results[path][0], results[path][1])
+
+
 def prototest():
     sample = 'idfa\t1rfw452y52g2gq4g\t55.55\t42.42\t1423,43,567,3,7,23\ngaid\t7rfw452y52g2gq4g\t55.55\t42.42\t7423,424'
     for line in sample.splitlines():
@@ -197,19 +1091,66 @@ def prototest():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        assert encode_user_apps(apps, lat, lon) == packed
+
+    rnd = random.Random(0)
+    for _ in range(10000):
+        apps = [rnd.choice([rnd.randrange(128), rnd.randrange(1 << 14, 1 << 21), rnd.randrange(1 << 32)])
+                for _ in range(rnd.randrange(20))]
+        lat, lon = rnd.choice([0.0, -0.0, rnd.uniform(-90, 90), float('inf')]), rnd.uniform(-180, 180)
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = lat
+        ua.lon = lon
+        ua.apps.extend(apps)
+        assert encode_user_apps(apps, lat, lon) == ua.SerializeToString()
+        assert encode_user_apps(array('I', apps), lat, lon) == ua.SerializeToString()
 
 
 def main(options):
     device_memc = {
-        'idfa': options.idfa,
-        'gaid': options.gaid,
-        'adid': options.adid,
-        'dvid': options.dvid,
+        'idfa': HashRing(options.idfa.split(',')),
+        'gaid': HashRing(options.gaid.split(',')),
+        'adid': HashRing(options.adid.split(',')),
+        'dvid': HashRing(options.dvid.split(',')),
     }
-    pool = multiprocessing.Pool(processes=WORKER_COUNT)
+    process_options = {
+        'batch_size': options.batch_size,
+        'batch_linger': options.batch_linger,
+        'queue_size': options.queue_size,
+        'engine': options.engine,
+        'connections_count': options.connections,
+    }
+    pool_options = {}
+    reporter = None
+    if options.progress_interval or options.metrics_port:
+        metrics_queue = multiprocessing.Queue()
+        reporter = ProgressReporter(metrics_queue, options.progress_interval, options.metrics_port)
+        pool_options = {'initializer': run_metrics_flusher, 'initargs': (metrics_queue,)}
+    pool = multiprocessing.Pool(processes=WORKER_COUNT, **pool_options)
+    # started after the fork, so no worker inherits a metrics lock held by the reporter
+    if reporter:
+        reporter.start()
     path_list = sorted(path for path in glob.iglob(options.pattern))
-    for path in pool.imap(partial(process_file, device_memc=device_memc, dry=options.dry), path_list):
+    if options.chunk_mb:
+        process = partial(process_chunk, device_memc=device_memc, dry=options.dry, **process_options)
+        processed_paths = process_files_chunked(
+            pool, path_list, process, options.chunk_mb * 1024 * 1024, WORKER_COUNT * 2, options.resume
+        )
+    else:
+        # biggest files first, so a large file does not start last and leave the other workers idle
+        path_list.sort(key=os.path.getsize, reverse=True)
+        process = partial(
+            process_file, device_memc=device_memc, dry=options.dry, resume=options.resume,
+            checkpoint_lines=options.checkpoint_lines, **process_options
+        )
+        processed_paths = pool.imap_unordered(process, path_list)
+    for path in processed_paths:
+        remove_checkpoint(path)
         dot_rename(path)
+    pool.close()
+    pool.join()
+    if reporter:
+        reporter.stop()
 
 
 if __name__ == '__main__':
@@ -218,6 +1159,16 @@ if __name__ == '__main__':
     op.add_option('-l', '--log', action='store', default=None)
     op.add_option('--dry', action='store_true', default=False)
     op.add_option('--pattern', action='store', default='data/*.tsv.gz')
+    op.add_option('--batch-size', action='store', type='int', default=MEMCACHE_BATCH_SIZE)
+    op.add_option('--batch-linger', action='store', type='float', default=MEMCACHE_BATCH_LINGER)
+    op.add_option('--queue-size', action='store', type='int', default=MAX_TASK_QUEUE_SIZE)
+    op.add_option('--engine', action='store', type='choice', choices=['threads', 'async'], default='threads')
+    op.add_option('--connections', action='store', type='int', default=MEMCACHE_CONNECTIONS_PER_ADDR)
+    op.add_option('--chunk-mb', action='store', type='int', default=0)
+    op.add_option('--resume', action='store_true', default=False)
+    op.add_option('--checkpoint-lines', action='store', type='int', default=CHECKPOINT_LINES)
+    op.add_option('--progress-interval', action='store', type='int', default=PROGRESS_INTERVAL)
+    op.add_option('--metrics-port', action='store', type='int', default=0)
     op.add_option('--idfa', action='store', default='127.0.0.1:33013')
     op.add_option('--gaid', action='store', default='127.0.0.1:33014')
     op.add_option('--adid', action='store', default='127.0.0.1:33015')
@@ -0,0 +1,341 @@
+import asyncio
+import gzip
+import os
+import queue
+import shutil
+import socket
+import tempfile
+from multiprocessing.pool import ThreadPool
+from unittest import TestCase, mock
+
+from benchmark import FakeMemcached, generate_files, get_load_options, restore_files
+import memc_load
+from memc_load import (
+    AppsInsertPool,
+    AppsInstalled,
+    AppsParser,
+    AsyncMemcacheConnections,
+    CircuitBreaker,
+    collect_results,
+    get_checkpoint_path,
+    HashRing,
+    LATENCY_BUCKETS,
+    load_checkpoint,
+    Metrics,
+    parse_appsinstalled,
+    parse_appsinstalled_batch,
+    process_file,
+    process_lines,
+    RetryScheduler,
+    save_checkpoint,
+)
+
+NODES = ['127.0.0.1:33013', '127.0.0.1:33014', '127.0.0.1:33015', '127.0.0.1:33016']
+# produced by libmemcached-compatible ketama (uhashring with hash_fn='ketama')
+KETAMA_VECTORS = {
+    'idfa:1rfw452y52g2gq4g': '127.0.0.1:33015',
+    'gaid:7rfw452y52g2gq4g': '127.0.0.1:33013',
+    'idfa:00000000000000000000000000000000': '127.0.0.1:33014',
+    'gaid:00000000000000000000000000001eef': '127.0.0.1:33016',
+    'adid:00000000000000000000000000003dde': '127.0.0.1:33015',
+    'dvid:00000000000000000000000000005ccd': '127.0.0.1:33016',
+    'gaid:00000000000000000000000000009aab': '127.0.0.1:33013',
+    'gaid:00000000000000000000000000011667': '127.0.0.1:33014',
+    'adid:00000000000000000000000000013556': '127.0.0.1:33016',
+    'dvid:00000000000000000000000000015445': '127.0.0.1:33015',
+}
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestMemcLoad(TestCase):
+    def test_hash_ring(self):
+        ring = HashRing(NODES)
+        for key, node in KETAMA_VECTORS.items():
+            self.assertEqual(ring.get_node(key), node)
+
+        keys = ['idfa:%032x' % index for index in range(1000)]
+        smaller_ring = HashRing(NODES[:-1])
+        for key in keys:
+            if ring.get_node(key) != NODES[-1]:
+                self.assertEqual(smaller_ring.get_node(key), ring.get_node(key))
+        self.assertEqual(HashRing(NODES[:1]).get_node(keys[0]), NODES[0])
+
+    def test_parsers_agree(self):
+        lines = [
+            b'idfa\tid1\t55.55\t42.42\t1423,43,567\n',
+            b'  gaid\tid2\t1\t-2.5\t1, 2,x,3\r\n',
+            b'adid\tid3\t1\t2\t\n',
+            b'adid\tid4\t1\t2\t-1,7,+8,4294967295,4294967296\n',
+            b'dvid\tid5\t1\t2\tx\n',
+            b'dvid\tid6\tx\t2\t1\n',
+            b'dvid\tid7\t1\t2\t3\textra\n',
+            b'\tid8\t1\t2\t3\n',
+            b'idfa\t\xff\t1\t2\t3\n',
+            b'idfa\tid9\t1\t2\t3,\xff\n',
+            b'\n',
+        ]
+        records = [parse_appsinstalled(line) for line in lines if line.strip()]
+        batch = parse_appsinstalled_batch(lines)
+        self.assertEqual(batch.errors, records.count(None))
+        self.assertEqual(batch.dev_types, ['idfa', 'gaid', 'adid', 'dvid'])
+        self.assertEqual(list(batch.apps_offsets), [0, 3, 6, 9, 9, 10])
+        batch_records = [
+            AppsInstalled(
+                batch.dev_types[code], batch.dev_ids[index], batch.lats[index], batch.lons[index],
+                list(batch.apps[batch.apps_offsets[index]:batch.apps_offsets[index + 1]])
+            )
+            for index, code in enumerate(batch.dev_type_codes)
+        ]
+        self.assertEqual(batch_records, [record for record in records if record])
+        self.assertEqual(batch_records[1], AppsInstalled('gaid', 'id2', 1.0, -2.5, [1, 2, 3]))
+        self.assertEqual(batch_records[2].apps, [7, 8, 4294967295])
+        self.assertEqual(batch_records[3].apps, [])
+
+    def test_batch_retries_failed_keys(self):
+        batches = []
+
+        class Client:
+            def __init__(self, servers, socket_timeout):
+                pass
+
+            def set_multi(self, batch):
+                batches.append(dict(batch))
+                return ['idfa:id1'] if len(batches) > 1 else ['idfa:id1', 'idfa:id2']
+
+        lines = [b'idfa\tid%d\t1.0\t2.0\t1,2\n' % index for index in range(4)]
+        with mock.patch('memc_load.memcache.Client', Client), mock.patch('memc_load.THREADS_PER_WORKER', 1), \
+                mock.patch('memc_load.MEMCACHE_BACKOFF_FACTOR', 0):
+            processed, errors, node_stats = process_lines(lines, {'idfa': HashRing(NODES[:1])}, False, batch_size=4)
+        self.assertEqual((processed, errors), (3, 1))
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(sorted(batches[0]), ['idfa:id%d' % index for index in range(4)])
+        self.assertEqual(batches[1], {key: batches[0][key] for key in ['idfa:id1', 'idfa:id2']})
+        self.assertEqual(node_stats[NODES[0]][:3], [3, 1, 2])
+
+    def test_insert_pool_shutdown(self):
+        stored = []
+
+        class Client:
+            def __init__(self, servers, socket_timeout):
+                pass
+
+            def set_multi(self, batch):
+                stored.extend(batch)
+                return []
+
+        lines = [b'idfa\tid%d\t1.0\t2.0\t1,2\n' % index for index in range(10)] + [b'idfa\tbroken\n']
+        task_queue = queue.Queue(maxsize=2)
+        result_queue = queue.Queue()
+        with mock.patch('memc_load.memcache.Client', Client):
+            # pending batches are only sent by the flush on shutdown
+            pool = AppsInsertPool(3, task_queue, result_queue, batch_size=100, batch_linger=60)
+            pool.run_threads()
+            AppsParser(task_queue, result_queue).run(lines, {'idfa': HashRing(NODES[:1])}, False)
+            pool.stop()
+            pool.wait()
+        self.assertFalse(any(thread.is_alive() for thread in pool.threads))
+        self.assertEqual(result_queue.qsize(), 4)
+        self.assertEqual(collect_results(result_queue, 4)[:2], (10, 1))
+        self.assertTrue(result_queue.empty())
+        self.assertEqual(sorted(stored), sorted('idfa:id%d' % index for index in range(10)))
+
+    def test_async_set_multi(self):
+        port = get_free_port()
+        server = FakeMemcached([port], failure_rate=0.3)
+        server.start()
+        self.addCleanup(server.stop)
+        # values hold line breaks, so replies are only parsed right if the value lengths are
+        batch = {'idfa:id%d' % index: b'\r\n' * index for index in range(50)}
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def handle_closed(reader, writer):
+            writer.close()
+
+        async def set_multi():
+            closed_server = await asyncio.start_server(handle_closed, '127.0.0.1', 0)
+            closed_port = closed_server.sockets[0].getsockname()[1]
+            connections = AsyncMemcacheConnections('127.0.0.1:%s' % port, connections_count=1)
+            closed_connections = AsyncMemcacheConnections('127.0.0.1:%s' % closed_port, connections_count=1)
+            try:
+                return [
+                    await connections.set_multi(batch),
+                    await connections.set_multi(batch),
+                    await closed_connections.set_multi(batch),
+                ]
+            finally:
+                await connections.close()
+                await closed_connections.close()
+                closed_server.close()
+
+        failed_keys, retried_failed_keys, closed_failed_keys = loop.run_until_complete(set_multi())
+        self.assertEqual(server.stored + server.failed, 2 * len(batch))
+        self.assertEqual(len(failed_keys) + len(retried_failed_keys), server.failed)
+        self.assertTrue(failed_keys and set(failed_keys) < set(batch))
+        self.assertEqual(closed_failed_keys, list(batch))
+
+    def test_async_engine(self):
+        port = get_free_port()
+        server = FakeMemcached([port])
+        server.start()
+        self.addCleanup(server.stop)
+        lines = [b'idfa\tid%d\t1.0\t2.0\t1,2\n' % index for index in range(100)] + [b'idfa\tbroken\n']
+        processed, errors, node_stats = process_lines(
+            lines, {'idfa': HashRing(['127.0.0.1:%s' % port])}, False, batch_size=30, engine='async'
+        )
+        self.assertEqual((processed, errors), (100, 1))
+        self.assertEqual(server.stored, 100)
+        self.assertEqual(node_stats['127.0.0.1:%s' % port][2], 4)
+
+    def test_circuit_breaker(self):
+        with mock.patch('memc_load.monotonic', return_value=100):
+            breaker = CircuitBreaker(NODES[0], failures_threshold=2, reset_timeout=5)
+            breaker.record(False)
+            self.assertTrue(breaker.allow())
+            breaker.record(False)
+            self.assertFalse(breaker.allow())
+        with mock.patch('memc_load.monotonic', return_value=105):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record(False)
+            self.assertFalse(breaker.allow())
+        with mock.patch('memc_load.monotonic', return_value=110):
+            self.assertTrue(breaker.allow())
+            breaker.record(True)
+            self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.allow())
+
+    def test_retry_scheduler(self):
+        retries = RetryScheduler()
+        self.assertIsNone(retries.next_due())
+        retries.schedule(20, NODES[1], {'b': b''}, 1)
+        retries.schedule(10, NODES[0], {'a': b''}, 1)
+        self.assertEqual(retries.next_due(), 10)
+        self.assertIsNone(retries.pop_due(5))
+        self.assertEqual(retries.pop_due(15), (NODES[0], {'a': b''}, 1))
+        self.assertIsNone(retries.pop_due(15))
+        self.assertEqual(retries.pop_due(20), (NODES[1], {'b': b''}, 1))
+        self.assertEqual(len(retries), 0)
+
+    def test_chunked_load(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path, = generate_files(temp_dir, 1, 12000)
+        with gzip.open(path) as file:
+            data = file.read()
+        ports = [get_free_port() for _ in range(4)]
+        server = FakeMemcached(ports)
+        server.start()
+        self.addCleanup(server.stop)
+        options = get_load_options(os.path.join(temp_dir, '*.tsv.gz'), ports, 'threads', 500)
+        options.chunk_mb = 1
+
+        with mock.patch('memc_load.multiprocessing.Pool', ThreadPool), \
+                mock.patch('memc_load.save_checkpoint', wraps=save_checkpoint) as save:
+            memc_load.main(options)
+        offsets = [call[0][1] for call in save.call_args_list]
+        self.assertGreater(len(offsets), 1)
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertEqual(offsets[-1], len(data))
+        self.assertEqual(data[offsets[0] - 1:offsets[0]], b'\n')
+        self.assertEqual(server.stored, 12000)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(get_checkpoint_path(path)))
+
+        restore_files([path])
+        save_checkpoint(path, offsets[0], data[:offsets[0]].count(b'\n'), 0)
+        options.resume = True
+        with mock.patch('memc_load.multiprocessing.Pool', ThreadPool):
+            memc_load.main(options)
+        self.assertEqual(server.stored, 12000 + data[offsets[0]:].count(b'\n'))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(get_checkpoint_path(path)))
+
+    def test_metrics(self):
+        worker_metrics = Metrics()
+        file = mock.Mock()
+        file.tell.return_value = 100
+        file.fileobj.tell.return_value = 40
+        with mock.patch('memc_load.os.path.getsize', return_value=80):
+            worker_metrics.add_file_progress('data/a"\\.tsv.gz', 10, file)
+        worker_metrics.add_node_counts(NODES[0], 10, 1, 2)
+        worker_metrics.observe_latency(NODES[0], 0.003)
+        worker_metrics.observe_latency(NODES[0], 0.25)
+        worker_metrics.track_queue('tasks', lambda: 5)
+        delta = worker_metrics.flush()
+        self.assertEqual(worker_metrics.flush(), {'files': {}, 'nodes': {}, 'queues': {'tasks': 5}})
+
+        metrics = Metrics()
+        metrics.merge(1, delta)
+        buckets = [0] * len(LATENCY_BUCKETS)
+        buckets[-1] = 1
+        metrics.merge(2, {
+            'files': {'data/a"\\.tsv.gz': [5, 150, 60, 80]},
+            'nodes': {NODES[0]: [1, 0, 0, 1, 20.0, buckets]},
+            'queues': {'tasks': 2, 'retries': 1},
+        })
+        # a newer report of a worker replaces its queue depths
+        metrics.merge(1, {'files': {}, 'nodes': {}, 'queues': {'tasks': 3}})
+        lines = metrics.render_prometheus().splitlines()
+        for line in [
+            '# TYPE memc_load_file_lines counter',
+            'memc_load_file_lines_total{file="data/a\\"\\\\.tsv.gz"} 15',
+            'memc_load_file_read_bytes{file="data/a\\"\\\\.tsv.gz"} 150',
+            'memc_load_file_compressed_read_bytes{file="data/a\\"\\\\.tsv.gz"} 60',
+            'memc_load_records_total{memc_addr="127.0.0.1:33013"} 11',
+            'memc_load_errors_total{memc_addr="127.0.0.1:33013"} 1',
+            'memc_load_retries_total{memc_addr="127.0.0.1:33013"} 2',
+            'memc_load_queue_depth{queue="retries"} 1',
+            'memc_load_queue_depth{queue="tasks"} 5',
+            '# TYPE memc_load_batch_latency_seconds histogram',
+            'memc_load_batch_latency_seconds_bucket{memc_addr="127.0.0.1:33013",le="0.001"} 0',
+            'memc_load_batch_latency_seconds_bucket{memc_addr="127.0.0.1:33013",le="0.005"} 1',
+            'memc_load_batch_latency_seconds_bucket{memc_addr="127.0.0.1:33013",le="0.25"} 2',
+            'memc_load_batch_latency_seconds_bucket{memc_addr="127.0.0.1:33013",le="15"} 2',
+            'memc_load_batch_latency_seconds_bucket{memc_addr="127.0.0.1:33013",le="+Inf"} 3',
+            'memc_load_batch_latency_seconds_sum{memc_addr="127.0.0.1:33013"} 20.253',
+            'memc_load_batch_latency_seconds_count{memc_addr="127.0.0.1:33013"} 3',
+        ]:
+            self.assertIn(line, lines)
+
+    def test_checkpoint_resume(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'apps.tsv.gz')
+        lines = [b'idfa\tid%d\t1.0\t2.0\t1,2\n' % index for index in range(10)]
+        with gzip.open(path, 'wb') as file:
+            file.writelines(lines)
+
+        segments = []
+
+        def process_lines(segment, device_memc, dry, **kwargs):
+            segment = list(segment)
+            if len(segments) == 2:
+                raise RuntimeError('Interrupted')
+            if segment:
+                segments.append(segment)
+            return len(segment), 0, {}
+
+        with mock.patch('memc_load.process_lines', process_lines):
+            with self.assertRaises(RuntimeError):
+                process_file(path, {}, False, checkpoint_lines=3)
+            checkpoint = load_checkpoint(path)
+            self.assertEqual(checkpoint['offset'], len(b''.join(lines[:6])))
+            self.assertEqual(checkpoint['processed'], 6)
+
+            segments.clear()
+            process_file(path, {}, False, resume=True, checkpoint_lines=4)
+        self.assertEqual(segments, [lines[6:10]])
+        self.assertEqual(load_checkpoint(path)['processed'], 10)
+
+        with gzip.open(path, 'ab') as file:
+            file.write(lines[0])
+        self.assertIsNone(load_checkpoint(path))
+
+    def test_prototest(self):
+        memc_load.prototest()